@@ -0,0 +1,138 @@
+import argparse
+import json
+import pathlib
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import numpy as np
+import pandas as pd
+from download import PIDS_PER_REQUEST, fetch_patterns
+from benchmarks.synthetic import synthetic_pattern
+
+# Functions -------------------------------------------------------------------
+
+
+def serve_patterns(
+    patterns: dict[str, pd.DataFrame], latency: float = 0
+) -> tuple[ThreadingHTTPServer, str]:
+    """
+    start a stand-in for the Bus Tracker getpatterns endpoint on a free local
+    port, in a background thread. It answers like the API: up to
+    PIDS_PER_REQUEST comma separated pids, an error entry for pids it doesn't
+    have. Returns the server, to shutdown() when done, and its url
+
+    Arguments:
+        - patterns: raw pattern df of each pid, like synthetic_pattern
+        - latency: seconds each response waits, to stand in for the network
+    """
+
+    class PatternHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            query = parse_qs(urlparse(self.path).query)
+            pids = query.get("pid", [""])[0].split(",")
+
+            if len(pids) > PIDS_PER_REQUEST:
+                response = {"error": [{"msg": "Too many pattern ids"}]}
+            else:
+                response = {
+                    "ptr": [
+                        {
+                            "pid": int(pid),
+                            "pt": patterns[pid].to_dict(orient="records"),
+                        }
+                        for pid in pids
+                        if pid in patterns
+                    ],
+                    "error": [
+                        {"pid": pid, "msg": "No data found for parameter"}
+                        for pid in pids
+                        if pid not in patterns
+                    ],
+                }
+
+            time.sleep(latency)
+            body = json.dumps({"bustime-response": response}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PatternHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, f"http://127.0.0.1:{server.server_port}/getpatterns"
+
+
+def benchmark_fetch_patterns(
+    pids: int, stops: int, workers: int, latency: float, per_second: float
+) -> dict:
+    """
+    time download.fetch_patterns against the stand-in server, with a few
+    pids it doesn't have
+    """
+
+    rng = np.random.default_rng(0)
+    patterns = {
+        str(4000 + p): synthetic_pattern(str(4000 + p), stops, rng) for p in range(pids)
+    }
+    server, url = serve_patterns(patterns, latency)
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            start = time.perf_counter()
+            found, failed = fetch_patterns(
+                [*patterns, "1", "2"],
+                tmp,
+                workers=workers,
+                api_url=url,
+                api_key="local",
+                per_second=per_second,
+            )
+            seconds = time.perf_counter() - start
+            written = len(list(pathlib.Path(tmp).glob("pid_*_raw.parquet")))
+    finally:
+        server.shutdown()
+
+    return {
+        "found": len(found),
+        "failed": len(failed),
+        "written": written,
+        "seconds": round(seconds, 3),
+        "pids_per_sec": round(len(found) / seconds),
+    }
+
+
+# Implementation --------------------------------------------------------------
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark fetching patterns from a local stand-in for the Bus Tracker API."
+    )
+    parser.add_argument("--pids", type=int, default=300, help="Patterns to fetch")
+    parser.add_argument("--stops", type=int, default=120, help="Points per pattern")
+    parser.add_argument("--workers", type=int, default=4, help="Concurrent requests")
+    parser.add_argument(
+        "--latency", type=float, default=0.2, help="Seconds per response"
+    )
+    parser.add_argument(
+        "--per_second", type=float, default=5, help="Requests per second allowed"
+    )
+    args = parser.parse_args()
+
+    result = benchmark_fetch_patterns(
+        args.pids, args.stops, args.workers, args.latency, args.per_second
+    )
+    print(
+        f"fetch_patterns: {result['found']} found, {result['failed']} failed in "
+        f"{result['seconds']}s ({result['pids_per_sec']} pids/sec)"
+    )
+
+# End -------------------------------------------------------------------------
@@ -0,0 +1,58 @@
+import argparse
+import pathlib
+import tempfile
+import time
+import pandas as pd
+import metrics_utils
+from benchmarks.synthetic import synthetic_timetable
+
+# Functions -------------------------------------------------------------------
+
+
+def benchmark_schedule_trips(days: int, trips: int, stops: int) -> dict:
+    """
+    time metrics_utils.create_trips_df on a synthetic schedule for one route
+    """
+
+    timetable = synthetic_timetable(days, trips, stops)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        data_dir = pathlib.Path(tmp)
+        (data_dir / "clean_timetables").mkdir()
+        timetable.to_parquet(data_dir / "clean_timetables/rt79_timetable.parquet")
+        pd.DataFrame({"rt": ["79"], "pid": ["4357"]}).to_parquet(
+            data_dir / "rt_to_pid.parquet"
+        )
+
+        metrics_utils.DIR = data_dir
+        start = time.perf_counter()
+        trips_df = metrics_utils.create_trips_df("79", is_schedule=True).collect()
+        seconds = time.perf_counter() - start
+
+    return {
+        "rows": trips_df.height,
+        "seconds": round(seconds, 3),
+        "rows_per_sec": round(trips_df.height / seconds),
+    }
+
+
+# Implementation --------------------------------------------------------------
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark building schedule trips from a synthetic timetable."
+    )
+    parser.add_argument("--days", type=int, default=30, help="Days of schedule")
+    parser.add_argument("--trips", type=int, default=300, help="Trips per day")
+    parser.add_argument("--stops", type=int, default=80, help="Stops per trip")
+    args = parser.parse_args()
+
+    result = benchmark_schedule_trips(args.days, args.trips, args.stops)
+    print(
+        f"create_trips_df schedule: {result['rows']:,} rows in "
+        f"{result['seconds']}s ({result['rows_per_sec']:,} rows/sec)"
+    )
+
+# End -------------------------------------------------------------------------
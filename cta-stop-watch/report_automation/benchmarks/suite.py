@@ -0,0 +1,342 @@
+import argparse
+import json
+import os
+import pathlib
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+from typing import Callable
+import pandas as pd
+import polars as pl
+import calculate_stop_time
+import metrics_utils
+import process_patterns
+import update_schedule
+from calculate_stop_time import (
+    calculate_pattern,
+    pattern_bundle,
+    prepare_segment,
+    prepare_stops,
+    prepare_trips,
+    process_one_trip,
+    query_segments,
+)
+from interpolation import interpolate_stoptime
+from metrics_utils import group_metrics
+from stop_metrics import prepare_route_metrics
+from utils import sample_peak_rss
+from benchmarks.synthetic import (
+    synthetic_feed_timetable,
+    synthetic_timetable,
+    write_synthetic_data,
+)
+
+# Constants -------------------------------------------------------------------
+
+# Paths
+DIR = pathlib.Path(__file__).parent.parent / "data"
+RESULTS_FILE = DIR / "benchmarks" / "results.jsonl"
+
+STEPS = [
+    "process_patterns",
+    "calculate_pattern",
+    "interpolate_stoptime",
+    "group_metrics",
+    "dedupe_schedules",
+]
+
+# Functions -------------------------------------------------------------------
+
+
+def measure(step: str, rows: int, function: Callable, *args) -> dict:
+    """
+    time one call of function and sample the peak memory of the process
+    while it runs
+    """
+
+    with sample_peak_rss(step, logger=None, interval=0.05) as peak:
+        start = time.perf_counter()
+        function(*args)
+        seconds = time.perf_counter() - start
+
+    return {
+        "step": step,
+        "rows": rows,
+        "seconds": round(seconds, 3),
+        "rows_per_sec": round(rows / seconds),
+        "peak_rss_mb": round(peak["rss"] / 2**20, 1),
+    }
+
+
+def route_stops_and_pings(pid: str) -> pd.DataFrame:
+    """
+    the stops and bus locations of all the trips of a pattern, the input
+    calculate_pattern gives to interpolate_stoptime
+    """
+
+    bundle = pattern_bundle(pid)
+    segments_gdf = prepare_segment(pid, bundle)
+    trips_gdf, _, _ = prepare_trips(pid)
+    stops_df = prepare_stops(pid, bundle)
+
+    candidates_gdf = query_segments(trips_gdf, segments_gdf)
+    candidates_by_trip = dict(
+        tuple(candidates_gdf.groupby("unique_trip_vehicle_day", sort=False))
+    )
+
+    all_trips = []
+    for trip_id, trip_gdf in trips_gdf.groupby("unique_trip_vehicle_day"):
+        try:
+            trip_df = process_one_trip(
+                trip_id,
+                trip_gdf,
+                candidates_by_trip.get(trip_id, candidates_gdf.iloc[:0]),
+                stops_df,
+            )
+        except Exception:
+            continue
+        if trip_df is not None:
+            all_trips.append(trip_df)
+
+    return pd.concat(all_trips, ignore_index=True)
+
+
+def interpolate_patterns(route_gdfs: list[pd.DataFrame]) -> None:
+    for route_gdf in route_gdfs:
+        interpolate_stoptime(route_gdf)
+
+
+def calculate_all_patterns(pids: list[str]) -> None:
+    for pid in pids:
+        calculate_pattern(pid)
+
+
+def write_feed_timetables(
+    data_dir: pathlib.Path, routes: int, days: int, trips: int, stops: int
+) -> int:
+    """
+    write the current timetables of routes and a clean timetable for each
+    that the current one overlaps, as dedupe_schedules expects them. Returns
+    the rows of the current timetables
+    """
+
+    current_dir = data_dir / "staging/timetables/current_timetables"
+    clean_dir = data_dir / "clean_timetables"
+    current_dir.mkdir(parents=True, exist_ok=True)
+    clean_dir.mkdir(parents=True, exist_ok=True)
+
+    rows = 0
+    for rt in range(1, routes + 1):
+        current = synthetic_feed_timetable(str(rt), days, trips, stops, "2024-02-01")
+        current.to_parquet(current_dir / f"rt{rt}_timetable.parquet", index=False)
+        rows += len(current)
+
+        historic = synthetic_timetable(days * 2, trips, stops, "2024-01-01")
+        historic["route_id"] = str(rt)
+        historic.to_parquet(clean_dir / f"rt{rt}_timetable.parquet")
+
+    return rows
+
+
+def run_suite(
+    pids: int,
+    stops: int,
+    trips: int,
+    days: int,
+    routes: int,
+    seed: int = 0,
+    steps: list[str] = STEPS,
+) -> list[dict]:
+    """
+    time each step of the pipeline on synthetic data written to a temporary
+    data folder. Returns one result per step
+
+    Arguments:
+        - pids: number of patterns
+        - stops: number of points of each pattern
+        - trips: trips of each pattern, and scheduled trips per day of each route
+        - days: days the trips and timetables cover
+        - routes: number of routes in the schedule
+        - seed: seed of the synthetic data
+        - steps: the steps to time, in the order of STEPS
+    """
+
+    results = []
+    cwd = os.getcwd()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        data_dir = pathlib.Path(tmp) / "data"
+        synthetic = write_synthetic_data(data_dir, pids, stops, trips, days, seed)
+
+        # point the pipeline at the synthetic data folder
+        process_patterns.PID_DIR = data_dir / "patterns"
+        calculate_stop_time.DIR = data_dir
+        metrics_utils.DIR = data_dir
+        metrics_utils.CHANGES_FILE = data_dir / "metrics/changed_partitions.parquet"
+
+        # patterns are needed by the steps after, even when not timed
+        if "process_patterns" in steps:
+            results.append(
+                measure(
+                    "process_patterns",
+                    synthetic["pattern_rows"],
+                    process_patterns.process_patterns,
+                    synthetic["pids"],
+                )
+            )
+        else:
+            process_patterns.process_patterns(synthetic["pids"])
+
+        if "calculate_pattern" in steps:
+            results.append(
+                measure(
+                    "calculate_pattern",
+                    synthetic["ping_rows"],
+                    calculate_all_patterns,
+                    synthetic["pids"],
+                )
+            )
+
+        if "interpolate_stoptime" in steps:
+            route_gdfs = [route_stops_and_pings(pid) for pid in synthetic["pids"]]
+            results.append(
+                measure(
+                    "interpolate_stoptime",
+                    sum(len(route_gdf) for route_gdf in route_gdfs),
+                    interpolate_patterns,
+                    route_gdfs,
+                )
+            )
+
+        if "group_metrics" in steps:
+            (data_dir / "clean_timetables").mkdir(exist_ok=True)
+            synthetic_timetable(days, trips, stops).to_parquet(
+                data_dir / "clean_timetables/rt79_timetable.parquet"
+            )
+            trips_df, metrics = prepare_route_metrics(
+                metrics_utils.create_trips_df("79", is_schedule=True),
+                is_schedule=True,
+            )
+            results.append(
+                measure(
+                    "group_metrics", trips_df.height, group_metrics, trips_df, metrics
+                )
+            )
+
+        if "dedupe_schedules" in steps:
+            rows = write_feed_timetables(data_dir, routes, days, trips, stops)
+            # dedupe_schedules reads and writes the data folder of the cwd
+            os.chdir(tmp)
+            try:
+                results.append(
+                    measure("dedupe_schedules", rows, update_schedule.dedupe_schedules)
+                )
+            finally:
+                os.chdir(cwd)
+
+    return results
+
+
+def current_commit() -> str:
+    """
+    short hash of the checked out commit, with a + if the tree has changes
+    """
+
+    def git(*args) -> str:
+        return subprocess.run(
+            ["git", *args], capture_output=True, text=True, cwd=DIR.parent
+        ).stdout.strip()
+
+    dirty = git("status", "--porcelain", "--untracked-files=no")
+    return git("rev-parse", "--short", "HEAD") + ("+" if dirty else "")
+
+
+def store_results(results: list[dict], scale: dict) -> None:
+    """
+    append the results of a run to RESULTS_FILE with the commit and the
+    scale they were run at
+    """
+
+    os.makedirs(RESULTS_FILE.parent, exist_ok=True)
+
+    run = {
+        "run": datetime.now().isoformat(timespec="seconds"),
+        "commit": current_commit(),
+        **scale,
+    }
+    with open(RESULTS_FILE, "a") as file:
+        for result in results:
+            file.write(json.dumps({**run, **result}) + "\n")
+
+
+def compare_results(scale: dict, last: int = 5) -> pl.DataFrame:
+    """
+    print the rows/sec and peak memory of each step for the last commits
+    benchmarked at the same scale, taking the latest run of each commit
+    """
+
+    results = pl.read_ndjson(RESULTS_FILE).filter(
+        *[pl.col(key) == value for key, value in scale.items()]
+    )
+    latest = results.group_by("commit").agg(pl.col("run").max())
+    commits = latest.sort("run").tail(last)
+
+    comparison = (
+        results.join(commits, on=["commit", "run"])
+        .sort("run")
+        .pivot(
+            on="commit",
+            index="step",
+            values=["rows_per_sec", "peak_rss_mb"],
+            aggregate_function="first",
+        )
+    )
+
+    with pl.Config(tbl_rows=-1, tbl_cols=-1, tbl_width_chars=200):
+        print(f"Benchmarks at {scale}")
+        print(comparison)
+
+    return comparison
+
+
+# Implementation --------------------------------------------------------------
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark pipeline steps on synthetic patterns, pings and timetables."
+    )
+    parser.add_argument("--pids", type=int, default=10, help="Number of patterns")
+    parser.add_argument("--stops", type=int, default=60, help="Points per pattern")
+    parser.add_argument("--trips", type=int, default=200, help="Trips per pattern")
+    parser.add_argument("--days", type=int, default=30, help="Days of data")
+    parser.add_argument("--routes", type=int, default=5, help="Routes in the schedule")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the data")
+    parser.add_argument(
+        "--steps", nargs="+", choices=STEPS, default=STEPS, help="Steps to time"
+    )
+    parser.add_argument(
+        "--compare",
+        action="store_true",
+        help="Only print the stored results of the last commits at this scale",
+    )
+    args = parser.parse_args()
+
+    scale = {
+        "pids": args.pids,
+        "stops": args.stops,
+        "trips": args.trips,
+        "days": args.days,
+        "routes": args.routes,
+        "seed": args.seed,
+    }
+
+    if not args.compare:
+        results = run_suite(**scale, steps=args.steps)
+        store_results(results, scale)
+
+    compare_results(scale)
+
+# End -------------------------------------------------------------------------
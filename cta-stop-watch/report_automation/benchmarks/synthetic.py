@@ -0,0 +1,273 @@
+import pathlib
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import polars as pl
+from download import column_types, dtype_map
+
+# Constants -------------------------------------------------------------------
+
+# patterns start around the loop, about 111km per degree of latitude
+ORIGIN = (41.88, -87.63)
+M_PER_DEGREE = 111_000
+M_TO_FT = 3.280839895
+
+# Functions -------------------------------------------------------------------
+
+
+def synthetic_pattern(pid: str, stops: int, rng: np.random.Generator) -> pd.DataFrame:
+    """
+    build a raw pattern shaped like the getpatterns response saved by
+    download.query_cta_api: a wandering line of stops and waypoints 80m to
+    400m apart
+
+    Arguments:
+        - pid: pattern id, used to make the stop ids
+        - stops: number of points (stops and waypoints) on the pattern
+        - rng: random generator, so a seed gives the same pattern
+    """
+
+    angle = np.cumsum(rng.normal(0, 0.2, stops)) + rng.uniform(0, 2 * np.pi)
+    step = rng.uniform(80, 400, stops)
+    step[0] = 0
+    x = np.cumsum(np.cos(angle) * step)
+    y = np.cumsum(np.sin(angle) * step)
+
+    typ = np.where(rng.random(stops) < 0.7, "S", "W")
+    typ[[0, -1]] = "S"
+
+    return pd.DataFrame(
+        {
+            "seq": np.arange(1, stops + 1),
+            "lat": ORIGIN[0] + y / M_PER_DEGREE,
+            "lon": ORIGIN[1] + x / (M_PER_DEGREE * np.cos(np.radians(ORIGIN[0]))),
+            "typ": typ,
+            "stpid": [f"{pid}{i:03d}" if t == "S" else "" for i, t in enumerate(typ)],
+            "stpnm": [f"Stop {i}" if t == "S" else "" for i, t in enumerate(typ)],
+            "pdist": np.cumsum(step) * M_TO_FT,
+        }
+    )
+
+
+def synthetic_pings(
+    pattern: pd.DataFrame,
+    pid: str,
+    rt: str,
+    trips: int,
+    days: int,
+    rng: np.random.Generator,
+    start: str = "2024-01-01",
+) -> pl.DataFrame:
+    """
+    build the bus locations of trips along a raw pattern with the columns of
+    download.dtype_map, typed like the staging files. Trips ping every 40s to
+    200s with gps noise, some run backwards, repeat their first ping or never
+    move, like the trips prepare_trips filters out
+
+    Arguments:
+        - pattern: raw pattern from synthetic_pattern
+        - pid, rt: ids of the pattern and its route
+        - trips: number of trips, spread over days
+        - days: number of days from start
+        - rng: random generator, so a seed gives the same pings
+    """
+
+    last = len(pattern) - 1
+    lat = pattern["lat"].to_numpy()
+    lon = pattern["lon"].to_numpy()
+
+    # number of pings of each trip and the trip of each ping
+    pings = rng.integers(5, max(6, last // 2), trips)
+    trip = np.repeat(np.arange(trips), pings)
+
+    # position along the pattern, sorted within each trip
+    position = np.sort(rng.uniform(0, last, len(trip)) + trip * last) - trip * last
+    backwards = rng.random(trips) < 0.1
+    position = np.where(backwards[trip], last - position, position)
+    first = np.r_[True, trip[1:] != trip[:-1]]
+    repeated = first & (rng.random(trips) < 0.2)[trip]
+    position[np.r_[False, repeated[:-1]]] = position[repeated]
+
+    i = np.floor(position).astype(int)
+    j = np.minimum(i + 1, last)
+    f = position - i
+    noise = rng.normal(0, 0.00005, (2, len(trip)))
+    ping_lat = lat[i] + (lat[j] - lat[i]) * f + noise[0]
+    ping_lon = lon[i] + (lon[j] - lon[i]) * f + noise[1]
+
+    parked = (rng.random(trips) < 0.03)[trip]
+    ping_lat[parked] = lat[0]
+    ping_lon[parked] = lon[0]
+
+    # trips leave between 5am and 10pm of a random day
+    departure = (
+        pd.Timestamp(start)
+        + pd.to_timedelta(rng.integers(0, days, trips), unit="D")
+        + pd.to_timedelta(rng.integers(5 * 60, 22 * 60, trips), unit="m")
+    )
+    elapsed = pd.Series(rng.integers(40, 200, len(trip))).groupby(trip).cumsum()
+    data_time = departure[trip] + pd.to_timedelta(elapsed.to_numpy(), unit="s")
+
+    vid = rng.integers(1000, 9000, trips)[trip]
+    tatripid = (10_000 + trip).astype(str)
+
+    pings_df = pl.DataFrame(
+        {
+            "vid": vid,
+            "tmstmp": data_time.strftime("%Y%m%d %H:%M"),
+            "lat": ping_lat,
+            "lon": ping_lon,
+            "hdg": rng.integers(0, 360, len(trip)),
+            "pid": float(pid),
+            "rt": rt,
+            "des": "Synthetic",
+            "pdist": "0",
+            "dly": False,
+            "tatripid": tatripid,
+            "origtatripno": tatripid,
+            "tablockid": "B1",
+            "zone": "",
+            "scrape_file": "synthetic",
+            "data_time": data_time.strftime("%Y-%m-%d %H:%M:%S"),
+            "data_hour": data_time.hour.astype(str),
+            "data_date": data_time.strftime("%Y-%m-%d"),
+        },
+        schema_overrides=dtype_map,
+    ).select(list(dtype_map))
+
+    # same id as download.save_partitioned_parquet, pid goes in as a double
+    return pings_df.with_columns(
+        pl.concat_str(
+            "rt", pl.col("pid").cast(pl.String), "tatripid", "vid", "data_date"
+        ).alias("unique_trip_vehicle_day")
+    ).with_columns(column_types)
+
+
+def synthetic_timetable(
+    days: int, trips: int, stops: int, start: str = "2024-01-01"
+) -> pd.DataFrame:
+    """
+    build a clean timetable for one route shaped like the output of
+    update_schedule.dedupe_schedules. Each day runs the same trips, so
+    schd_trip_id is reused across days like in the gtfs feed
+    """
+
+    day = np.repeat(np.arange(days), trips * stops)
+    trip = np.tile(np.repeat(np.arange(trips), stops), days)
+    stop = np.tile(np.arange(stops), days * trips)
+
+    # trips leave every few minutes from 5am, two minutes between stops
+    minutes = 5 * 60 + trip * (18 * 60 // trips) + stop * 2
+    bus_stop_time = (
+        datetime.fromisoformat(start)
+        + pd.to_timedelta(day, unit="D")
+        + pd.to_timedelta(minutes, unit="m")
+    )
+
+    schd_trip_id = trip.astype(str)
+
+    return pd.DataFrame(
+        {
+            "route_id": "79",
+            "pid": np.where(trip % 2 == 0, "4357", "4358"),
+            "schd_trip_id": schd_trip_id,
+            "stop_id": (1000 + stop).astype(str),
+            "stop_sequence": (stop + 1).astype(str),
+            "service_id": "1",
+            "trip_id": schd_trip_id,
+            "bus_stop_time": bus_stop_time,
+        }
+    )
+
+
+def synthetic_feed_timetable(
+    rt: str, days: int, trips: int, stops: int, start: str = "2024-01-01"
+) -> pd.DataFrame:
+    """
+    build a current timetable for one route shaped like the output of
+    update_schedule.create_timetables, with gtfs times so the last trips
+    arrive after 24:00:00
+    """
+
+    clean = synthetic_timetable(days, trips, stops, start)
+
+    # times are from the start of the service day, past 24:00:00 after midnight
+    day = pd.Timestamp(start) + pd.to_timedelta(
+        np.repeat(np.arange(days), trips * stops), unit="D"
+    )
+    seconds = (clean["bus_stop_time"] - day).dt.total_seconds().astype(int)
+
+    arrival_time = (
+        pd.Series(seconds // 3600).astype(str).str.zfill(2)
+        + ":"
+        + pd.Series(seconds % 3600 // 60).astype(str).str.zfill(2)
+        + ":"
+        + pd.Series(seconds % 60).astype(str).str.zfill(2)
+    )
+
+    return pd.DataFrame(
+        {
+            "route_id": rt,
+            "pid": clean["pid"],
+            "schd_trip_id": clean["schd_trip_id"],
+            "stop_id": clean["stop_id"],
+            "stop_sequence": clean["stop_sequence"].astype(int),
+            "date": day.strftime("%Y%m%d"),
+            "arrival_time": arrival_time,
+            "departure_time": arrival_time,
+            "service_id": clean["service_id"],
+            "trip_id": clean["trip_id"],
+            "sha1": None,
+            "fetched_date": start,
+        }
+    )
+
+
+def write_synthetic_data(
+    data_dir: pathlib.Path,
+    pids: int,
+    stops: int,
+    trips: int,
+    days: int,
+    seed: int = 0,
+) -> dict:
+    """
+    write raw patterns and the staging pings of each pattern into data_dir,
+    laid out like the data folder. Returns the pids and the rows written
+
+    Arguments:
+        - data_dir: folder to use as the data folder
+        - pids: number of patterns, two per route
+        - stops: number of points of each pattern
+        - trips: number of trips of each pattern
+        - days: days the trips are spread over
+        - seed: seed of the random generator
+    """
+
+    rng = np.random.default_rng(seed)
+
+    for folder in [
+        "patterns/patterns_raw",
+        "patterns/patterns_current",
+        "patterns/patterns_historic",
+        "staging/pids",
+    ]:
+        (data_dir / folder).mkdir(parents=True, exist_ok=True)
+
+    all_pids = [str(4000 + p) for p in range(pids)]
+    ping_rows = 0
+
+    for p, pid in enumerate(all_pids):
+        pattern = synthetic_pattern(pid, stops, rng)
+        pattern.to_parquet(data_dir / f"patterns/patterns_raw/pid_{pid}_raw.parquet")
+
+        pings = synthetic_pings(pattern, pid, str(p // 2 + 1), trips, days, rng)
+        pid_dir = data_dir / f"staging/pids/pid={pid}"
+        pid_dir.mkdir(exist_ok=True)
+        pings.drop("pid").write_parquet(pid_dir / "data_0.parquet")
+        ping_rows += pings.height
+
+    return {"pids": all_pids, "pattern_rows": pids * stops, "ping_rows": ping_rows}
+
+
+# End -------------------------------------------------------------------------
@@ -1,15 +1,22 @@
 import pandas as pd
+import numpy as np
 import warnings
 import geopandas as gpd
 from geopandas import GeoDataFrame
+from pyproj import Transformer
 import pathlib
-from shapely import box
+import duckdb
 import pickle
 import os
-import time
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from multiprocessing import get_context
 from datetime import date
 from utils import process_logger
+from telemetry import span
 from interpolation import interpolate_stoptime
+from process_patterns import read_manifest
 
 warnings.simplefilter(action="ignore", category=FutureWarning)
 
@@ -22,44 +29,48 @@ logging = process_logger
 
 DIR = pathlib.Path(__file__).parent / "data"
 
+# Projection the stop times are calculated in, in meters
+PROJ = "EPSG:26971"
+TO_PROJ = Transformer.from_crs("EPSG:4326", PROJ, always_xy=True)
+
+# Patterns kept in memory by each process, bump the version when the
+# bundles change so the ones on disk are rebuilt
+PATTERN_CACHE_SIZE = 64
+PATTERN_CACHE_VERSION = 3
+
 # Functions -------------------------------------------------------------------
 
 
-def prepare_segment(pid: str) -> gpd.GeoDataFrame:
+def prepare_segment(pid: str, bundle: dict | None = None) -> gpd.GeoDataFrame:
     """
     prepares the created segments from a pattern (pid) for use with the bus location.
+    The segments are shared through the pattern cache, don't modify them.
+    bundle is the pattern_bundle of the pid if it was already looked up
     """
-    # load segment
-    # try current and then historicgit
-    segments_gdf = pattern_opener(pid, "segment")
-
-    # .loc
-    segments_gdf["prev_segment"] = segments_gdf["segments"]
-    segments_gdf["segment"] = segments_gdf["segments"] + 1
-    segments_gdf = segments_gdf[["prev_segment", "segment", "geometry"]]
 
-    return segments_gdf
+    return (bundle or pattern_bundle(pid))["segments"]
 
 
-def prepare_trips(pid: str) -> tuple[GeoDataFrame, int]:
+def prepare_trips(pid: str) -> tuple[GeoDataFrame, int, int]:
     """
-    prepare the real trips from a pattern (pid) for use with the segments
+    prepare the real trips from a pattern (pid) for use with the segments.
+    Returns the filtered trips, and the number of trips and pings read
     """
 
-    # load trips for a pattern
-    trips_df = pd.read_parquet(f"{DIR}/staging/pids/{pid}.parquet")
+    # load trips for a pattern from its partition of staging/pids
+    command = f"""SELECT rt, pid, unique_trip_vehicle_day, vid, data_time, lat, lon
+    FROM read_parquet('{DIR}/staging/pids/pid={pid}/*.parquet',
+                      hive_partitioning = true)"""
+    with duckdb.connect() as con:
+        trips_df = con.execute(command).df()
 
-    trips_gdf = gpd.GeoDataFrame(
-        trips_df,
-        geometry=gpd.GeoSeries.from_xy(
-            x=trips_df.loc[:, "lon"],
-            y=trips_df.loc[:, "lat"],
-            crs="EPSG:4326",
-        ),
+    # project the pings once, everything after works on planar x/y in meters
+    trips_df["x"], trips_df["y"] = TO_PROJ.transform(
+        trips_df["lon"].to_numpy(), trips_df["lat"].to_numpy()
     )
-    trips_gdf = trips_gdf.sort_values("data_time")
-    trips_gdf["bus_location_id"] = trips_gdf.index
-    trips_gdf = trips_gdf[
+    trips_df = trips_df.sort_values("data_time")
+    trips_df["bus_location_id"] = trips_df.index
+    trips_df = trips_df[
         [
             "rt",
             "pid",
@@ -67,113 +78,168 @@ def prepare_trips(pid: str) -> tuple[GeoDataFrame, int]:
             "unique_trip_vehicle_day",
             "vid",
             "data_time",
-            "geometry",
+            "x",
+            "y",
         ]
     ]
 
-    og_trips_count = trips_gdf["unique_trip_vehicle_day"].nunique()
+    og_trips_count = trips_df["unique_trip_vehicle_day"].nunique()
 
     # remove trips with all pings in the sameish location
-    trips_gdf.to_crs(epsg=26971, inplace=True)
-    filtered_trips_gdf = trips_gdf.groupby("unique_trip_vehicle_day").filter(
-        lambda x: box(*x.geometry.total_bounds).area > 20
-    )
+    by_trip = trips_df[["x", "y"]].groupby(trips_df["unique_trip_vehicle_day"])
+    bounds = by_trip.transform("max") - by_trip.transform("min")
+    filtered_trips_df = trips_df[bounds["x"] * bounds["y"] > 20]
 
     # keep only last ping of any trips multiple first pings in the same spot
-    bad_indexes = []
-    for trip_id, trip_gdf in filtered_trips_gdf.groupby("unique_trip_vehicle_day"):
-        # if distance is super close
-        for i in range(len(trip_gdf) - 1):
-            if (
-                filtered_trips_gdf.geometry.iloc[i].distance(
-                    filtered_trips_gdf.geometry.iloc[i + 1]
-                )
-                < 5
-            ):
-                bad_indexes.append(trip_gdf.index[i])
-            else:
-                break
-
-    filtered_trips_gdf = filtered_trips_gdf[~filtered_trips_gdf.index.isin(bad_indexes)]
+    trip_groups = filtered_trips_df["unique_trip_vehicle_day"]
+    x = filtered_trips_df["x"]
+    y = filtered_trips_df["y"]
+    dist_next = np.sqrt(
+        (x.groupby(trip_groups).shift(-1) - x) ** 2
+        + (y.groupby(trip_groups).shift(-1) - y) ** 2
+    )
+    leading_close = (dist_next < 5).groupby(trip_groups).cummin()
+
+    filtered_trips_df = filtered_trips_df[~leading_close]
 
     # remove trips with only one ping
-    filtered_trips_gdf = filtered_trips_gdf.groupby("unique_trip_vehicle_day").filter(
-        lambda x: len(x) > 1
-    )
+    filtered_trips_df = filtered_trips_df[
+        filtered_trips_df.groupby("unique_trip_vehicle_day")[
+            "unique_trip_vehicle_day"
+        ].transform("size")
+        > 1
+    ]
     logging.debug(f"Originally {og_trips_count} trips for Pattern {pid}")
 
-    filtered_trips_gdf.to_crs(epsg=4326, inplace=True)
+    # points to query the segments with, in the projection of the pattern cache
+    filtered_trips_gdf = gpd.GeoDataFrame(
+        filtered_trips_df,
+        geometry=gpd.GeoSeries.from_xy(
+            x=filtered_trips_df["x"], y=filtered_trips_df["y"], crs=PROJ
+        ),
+    )
 
     return (
         filtered_trips_gdf,
         og_trips_count,
+        len(trips_df),
     )
 
 
-def prepare_stops(pid: str) -> GeoDataFrame:
+def prepare_stops(pid: str, bundle: dict | None = None) -> pd.DataFrame:
     """
-    Prepares the stops from a pattern (pid) for use with the bus location
+    Prepares the stops from a pattern (pid) for use with the bus location.
+    The stops are shared through the pattern cache, don't modify them.
+    bundle is the pattern_bundle of the pid if it was already looked up
     """
 
-    stops_gdf = pattern_opener(pid, "stop")
+    return (bundle or pattern_bundle(pid))["stops"]
+
+
+def assign_monotonic_segments(
+    bus_location_ids: np.ndarray, seg_combined: np.ndarray
+) -> np.ndarray:
+    """
+    given the sjoin rows of a trip sorted by time, return the positions of the
+    rows where each ping is assigned once and segments only move forward.
+    each round keeps the first eligible row per ping while segments increase
+    and restarts after the first one that goes backwards.
+    """
+
+    ping_codes, _ = pd.factorize(bus_location_ids)
+    segs = np.asarray(seg_combined, dtype="float64")
+    n_rows = len(segs)
+
+    good = np.zeros(n_rows, dtype=bool)
+    assigned = np.zeros(ping_codes.max() + 1 if n_rows else 0, dtype=bool)
+    last_segment = 0
+    start = 0
+
+    while start < n_rows:
+        # rows after the last assignment, past the last segment, of free pings
+        eligible = start + np.flatnonzero(
+            (segs[start:] > last_segment) & ~assigned[ping_codes[start:]]
+        )
+        if len(eligible) == 0:
+            break
+
+        # first eligible row of each ping, kept in time order
+        _, first = np.unique(ping_codes[eligible], return_index=True)
+        candidates = eligible[np.sort(first)]
+        candidate_segs = segs[candidates]
+
+        # candidates are only valid while they keep moving forward
+        prev_max = np.maximum.accumulate(
+            np.concatenate(([last_segment], candidate_segs[:-1]))
+        )
+        backwards = np.flatnonzero(candidate_segs <= prev_max)
+        stop = backwards[0] if len(backwards) else len(candidates)
+
+        kept = candidates[:stop]
+        good[kept] = True
+        assigned[ping_codes[kept]] = True
+        if len(kept):
+            last_segment = segs[kept[-1]]
+
+        if stop == len(candidates):
+            break
+        start = candidates[stop] + 1
+
+    return np.flatnonzero(good)
+
+
+def query_segments(trips_gdf: GeoDataFrame, segments_gdf: GeoDataFrame) -> GeoDataFrame:
+    """
+    find every segment that contains each bus location of the pattern. the
+    spatial index of the segments is built once and queried with all the pings
+    of the pattern at once, returns one row per ping and segment pair sorted by
+    trip, time and segment.
+    """
 
-    stops_gdf.rename(columns={"segment": "seg_combined"}, inplace=True)
-    stops_gdf["data_time"] = None
+    ping_idx, segment_idx = segments_gdf.sindex.query(
+        trips_gdf.geometry, predicate="within"
+    )
 
-    stops_gdf = stops_gdf[
-        ["seg_combined", "typ", "stpid", "p_stp_id", "geometry", "data_time"]
+    candidates_gdf = trips_gdf.iloc[ping_idx].reset_index(drop=True)
+    candidates_gdf["prev_segment"] = segments_gdf["prev_segment"].to_numpy()[
+        segment_idx
     ]
+    candidates_gdf["segment"] = segments_gdf["segment"].to_numpy()[segment_idx]
+    candidates_gdf["seg_combined"] = (
+        candidates_gdf["prev_segment"] + candidates_gdf["segment"]
+    ) / 2
 
-    stops_gdf.to_crs(epsg=4326, inplace=True)
+    # a ping can be in more than one segment, try the first segment it touches first
+    candidates_gdf = candidates_gdf.sort_values(
+        ["unique_trip_vehicle_day", "data_time", "seg_combined"], kind="stable"
+    ).reset_index(drop=True)
 
-    return stops_gdf
+    return candidates_gdf
 
 
 def merge_segments_trip(
-    trip_gdf: GeoDataFrame, segments_gdf: GeoDataFrame, stops_gdf: GeoDataFrame
-) -> GeoDataFrame:
+    candidates_gdf: GeoDataFrame, stops_df: pd.DataFrame
+) -> pd.DataFrame:
     """
     Confirm bus locations are on route and then create route df with bus location
-    """
 
-    # merge the bus locations with the segments to find the segment that the bus is in
-    trip_gdf["bus_location"] = trip_gdf.geometry
+    candidates_gdf are the rows of query_segments for one trip: the bus
+    locations with the segment that they are in.
+    """
 
     # TODO
     # write function to find pings not on route
 
-    processed_trips_gdf = segments_gdf.sjoin(
-        trip_gdf, how="inner", predicate="contains"
-    )
-
-    processed_trips_gdf["seg_combined"] = (
-        processed_trips_gdf["prev_segment"] + processed_trips_gdf["segment"]
-    ) / 2
-
     # determine which segment to put the bus in
     # try first segment it touches
     # if segment already has been assigned after that, try the next one
-
-    last_segment = 0
-    assigned_pings = []
-    good_indexes = []
-
-    processed_trips_gdf = processed_trips_gdf.sort_values("data_time").reset_index(
-        drop=True
-    )
+    processed_trips_gdf = candidates_gdf.reset_index(drop=True)
 
     # only overlap segments at end of segment
-
-    # i think itertuples is faster than iterrows.
-    for row in processed_trips_gdf.itertuples():
-        # if not assigned yet
-        if row.bus_location_id not in assigned_pings:
-            # if segment trying to assign is not before last segment assigned then assign
-            if row.seg_combined > last_segment:
-                good_indexes.append(row.Index)
-
-                last_segment = row.seg_combined
-                assigned_pings.append(row.bus_location_id)
+    good_indexes = assign_monotonic_segments(
+        processed_trips_gdf["bus_location_id"].to_numpy(),
+        processed_trips_gdf["seg_combined"].to_numpy(),
+    )
 
     processed_trips_gdf = processed_trips_gdf.loc[good_indexes]
 
@@ -184,11 +250,10 @@ def merge_segments_trip(
     # merge with stops to get full processed df
     processed_trips_gdf["typ"] = "B"
     processed_trips_gdf = processed_trips_gdf[
-        ["seg_combined", "typ", "bus_location", "data_time", "vid"]
+        ["seg_combined", "typ", "x", "y", "data_time", "vid"]
     ]
-    processed_trips_gdf.rename(columns={"bus_location": "geometry"}, inplace=True)
 
-    final_gdf = pd.concat([processed_trips_gdf, stops_gdf], axis=0)
+    final_gdf = pd.concat([processed_trips_gdf, stops_df], axis=0)
     final_gdf = final_gdf.reset_index(drop=True)
 
     final_gdf = final_gdf.sort_values(["seg_combined", "data_time"]).reset_index(
@@ -200,16 +265,16 @@ def merge_segments_trip(
 def process_one_trip(
     trip_id: str,
     trip_gdf: GeoDataFrame,
-    segments_gdf: GeoDataFrame,
-    stops_gdf: GeoDataFrame,
-) -> GeoDataFrame:
+    candidates_gdf: GeoDataFrame,
+    stops_df: pd.DataFrame,
+) -> pd.DataFrame:
     """
-    process one trip to return a df with the time a bus is at each stop.
-    for one trip, only keep points that are on route, then create route df
-    with bus location, then interpolate time when bus is at each stop.
+    process one trip to return a route df with the bus location and stops,
+    ready to interpolate. for one trip, only keep points that are on route,
+    then create route df with bus location.
     """
 
-    gdf = merge_segments_trip(trip_gdf, segments_gdf, stops_gdf)
+    gdf = merge_segments_trip(candidates_gdf, stops_df)
 
     # checks if dataframe is None for unprocessed trips
     if gdf is None:
@@ -217,8 +282,6 @@ def process_one_trip(
 
     gdf["unique_trip_vehicle_day"] = trip_id
 
-    gdf = interpolate_stoptime(gdf)
-
     gdf["vid"] = str(trip_gdf[trip_gdf["vid"].notna()]["vid"].unique()[0])
     gdf["rt"] = str(trip_gdf[trip_gdf["rt"].notna()]["rt"].unique()[0])
     gdf["pid"] = str(trip_gdf[trip_gdf["pid"].notna()]["pid"].unique()[0])
@@ -228,21 +291,23 @@ def process_one_trip(
 
 def calculate_pattern(
     pid: str, tester: str = float("inf")
-) -> tuple[GeoDataFrame, int, int, int] | tuple[None]:
+) -> tuple[pd.DataFrame, int, int, int, int] | tuple[None, None, None, None, int]:
     """
     Process all the trips for one pattern to return a df with the time a bus is at each stop for every trip.
     """
-    start_tmstm = time.time()
+    # look up the pattern once for its segments and stops
+    bundle = pattern_bundle(pid)
+
     # prepare the segments
-    segments_gdf = prepare_segment(pid)
+    segments_gdf = prepare_segment(pid, bundle)
 
     # prepare the trips
-    trips_gdf, og_trips_count = prepare_trips(pid)
+    trips_gdf, og_trips_count, pings_count = prepare_trips(pid)
 
     # prepare the stops
-    stops_gdf = prepare_stops(pid)
+    stops_df = prepare_stops(pid, bundle)
 
-    # for each trip in the pattern, create df that has the bus location and the segment that it is in then interpolate
+    # for each trip in the pattern, create df that has the bus location and the segment that it is in
     all_trips = []
     processed_trips_count = 0
 
@@ -255,10 +320,20 @@ def calculate_pattern(
         f"Trying to process {filtered_trips_count} trips for Pattern {pid} after filtering"
     )
 
+    # find the segments of all the bus locations of the pattern, then split by trip
+    candidates_gdf = query_segments(trips_gdf, segments_gdf)
+    candidates_by_trip = dict(
+        tuple(candidates_gdf.groupby("unique_trip_vehicle_day", sort=False))
+    )
+    no_candidates_gdf = candidates_gdf.iloc[:0]
+
     for trip_id, trip_gdf in trips_gdf.groupby("unique_trip_vehicle_day"):
         try:
             processed_trip_df = process_one_trip(
-                trip_id, trip_gdf, segments_gdf, stops_gdf
+                trip_id,
+                trip_gdf,
+                candidates_by_trip.get(trip_id, no_candidates_gdf),
+                stops_df,
             )
 
         except Exception as e:
@@ -272,27 +347,39 @@ def calculate_pattern(
         if processed_trip_df is None:
             continue
 
-        # put in a dictionary then make a df is much faster
-        processed_trip_dict = processed_trip_df.to_dict(orient="records")
-        all_trips += processed_trip_dict
+        all_trips.append(processed_trip_df)
 
         # for testing
         processed_trips_count += 1
         if processed_trips_count >= float(tester):
             break
 
-    end_tmstmp = time.time()
-    diff = end_tmstmp - start_tmstm
-    formatted_time = time.strftime("%H hours %M minutes %S", time.gmtime(diff))
+    # then interpolate all the trips of the pattern at once
+    if len(all_trips) > 0:
+        route_gdf = pd.concat(all_trips, ignore_index=True)
+        all_trips_df, bad_interpolation = interpolate_stoptime(route_gdf)
+
+        for trip_id in bad_interpolation:
+            logging.debug(
+                f"Error processing trip {trip_id} for Pattern {pid}. Error: could not interpolate stop times"
+            )
+        bad_trips += bad_interpolation
+        processed_trips_count -= len(bad_interpolation)
+
+        trip_columns = route_gdf[["unique_trip_vehicle_day", "vid", "rt", "pid"]]
+        all_trips_df = all_trips_df.merge(
+            trip_columns.drop_duplicates("unique_trip_vehicle_day"),
+            on="unique_trip_vehicle_day",
+            how="left",
+        )
 
     logging.debug(
-        f"Processed {processed_trips_count} trips for Pattern {pid}. There was {len(bad_trips)} trip(s) with errors. Time elapsed: {formatted_time}"
+        f"Processed {processed_trips_count} trips for Pattern {pid}. There was {len(bad_trips)} trip(s) with errors."
     )
 
-    # return 4 empty dataframes for unpacking in calculate_patterns
-    if len(all_trips) == 0:
-        return None, None, None, None
-    all_trips_df = pd.DataFrame(all_trips)
+    # return empty counts for unpacking in store_pattern, with the pings read
+    if processed_trips_count == 0:
+        return None, None, None, None, pings_count
     all_trips_df["bus_stop_time"] = pd.to_datetime(all_trips_df["bus_stop_time"])
 
     if not os.path.exists(f"{DIR}/qc"):
@@ -304,44 +391,84 @@ def calculate_pattern(
             # Pickle the 'data' using the highest protocol available.
             pickle.dump(bad_trips, f, pickle.HIGHEST_PROTOCOL)
 
-    return all_trips_df, og_trips_count, processed_trips_count, len(bad_trips)
+    return (
+        all_trips_df,
+        og_trips_count,
+        processed_trips_count,
+        len(bad_trips),
+        pings_count,
+    )
 
 
-def calculate_patterns(pids: list) -> bool:
+def store_pattern(pid: str, today_date: str) -> tuple[int, int, int]:
     """
-    calculate stop times for all the patterns
+    calculate stop times for one pattern and write them to staging/trips.
+    returns the og, processed and bad trip counts for the pattern.
     """
 
-    all_og_trips_count = 0
-    all_processed_trips_count = 0
-    all_bad_trips_count = 0
+    try:
+        # time is in the telemetry run log, see telemetry.span
+        with span("calculate_pattern", pid=pid) as record:
+            (
+                result,
+                og_trips_count,
+                processed_trips_count,
+                bad_trips_count,
+                pings_count,
+            ) = calculate_pattern(pid)
+            record["rows_in"] = pings_count
+            record["rows_out"] = 0 if result is None else len(result)
+            record["trips_in"] = og_trips_count
+            record["trips_out"] = processed_trips_count
+            record["bad_trips"] = bad_trips_count
+    except Exception as e:
+        logging.debug(f"Do not have pattern {pid}. Error: {e}")
+        return 0, 0, 0
+
+    if result is None:
+        return 0, 0, 0
+
+    # create the folder if it does not exist, workers may race on it
+    os.makedirs(f"{DIR}/staging/trips/{pid}", exist_ok=True)
+
+    result.to_parquet(
+        f"{DIR}/staging/trips/{pid}/trips_{pid}_{today_date}.parquet",
+        index=False,
+    )
 
-    today_date = str(date.today())
+    return og_trips_count, processed_trips_count, bad_trips_count
 
-    for pid in pids:
-        try:
-            result, og_trips_count, processed_trips_count, bad_trips_count = (
-                calculate_pattern(pid)
-            )
-        except Exception as e:
-            logging.debug(f"Do not have pattern {pid}. Error: {e}")
-            continue
 
-        if result is None:
-            continue
+def calculate_patterns(pids: list, workers: int | None = None) -> bool:
+    """
+    calculate stop times for all the patterns
 
-        # check if file exist and create if not
-        if not os.path.exists(f"{DIR}/staging/trips/{pid}"):
-            os.makedirs(f"{DIR}/staging/trips/{pid}")
+    Arguments:
+        - pids: list of patterns to process
+        - workers: number of processes to fan the patterns out to. Defaults
+        to the number of cores, 1 runs everything in this process.
+    """
 
-        result.to_parquet(
-            f"{DIR}/staging/trips/{pid}/trips_{pid}_{today_date}.parquet",
-            index=False,
-        )
+    today_date = str(date.today())
 
-        all_og_trips_count += og_trips_count
-        all_processed_trips_count += processed_trips_count
-        all_bad_trips_count += bad_trips_count
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if workers > 1 and len(pids) > 1:
+        logging.info(f"Calculating {len(pids)} patterns with {workers} workers")
+        # spawn, the parent has polars and duckdb thread pools that fork can't copy
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=get_context("spawn")
+        ) as executor:
+            counts = list(
+                executor.map(store_pattern, pids, repeat(today_date), chunksize=1)
+            )
+    else:
+        counts = [store_pattern(pid, today_date) for pid in pids]
+
+    all_og_trips_count = sum(count[0] for count in counts)
+    all_processed_trips_count = sum(count[1] for count in counts)
+    all_bad_trips_count = sum(count[2] for count in counts)
 
     logging.info(
         f"In total there were {all_og_trips_count} trips, {all_processed_trips_count} were processed, and {all_bad_trips_count} had errors."
@@ -350,21 +477,117 @@ def calculate_patterns(pids: list) -> bool:
     return True
 
 
+def pattern_path(pid: str, type: str) -> str:
+    """
+    path of a processed pattern file, current if there is one else historic
+    """
+
+    path = f"{DIR}/patterns/patterns_current/pid_{pid}_{type}.parquet"
+    if os.path.exists(path):
+        return path
+
+    return f"{DIR}/patterns/patterns_historic/pid_{pid}_{type}.parquet"
+
+
 def pattern_opener(pid: str, type: str) -> GeoDataFrame:
     """
     look for processed pattern date, try current then try historic
     """
-    # try current and then historic
-    if os.path.exists(f"{DIR}/patterns/patterns_current/pid_{pid}_{type}.parquet"):
-        gdf = gpd.read_parquet(
-            f"{DIR}/patterns/patterns_current/pid_{pid}_{type}.parquet"
-        )
-    else:
-        gdf = gpd.read_parquet(
-            f"{DIR}/patterns/patterns_historic/pid_{pid}_{type}.parquet"
-        )
 
-    return gdf
+    return gpd.read_parquet(pattern_path(pid, type))
+
+
+def pattern_hash(pid: str) -> str:
+    """
+    key of the bundle of a pattern: the manifest key of the raw pattern it
+    was built from (see process_patterns.pattern_key), or the size and
+    modification time of the processed files of patterns without one, and
+    the version of the bundles. process_patterns removes the bundles of the
+    patterns it rebuilds
+    """
+
+    key = read_manifest().get(pid)
+    if key is None:
+        stats = [os.stat(pattern_path(pid, type)) for type in ["segment", "stop"]]
+        key = "-".join(f"{stat.st_size}.{stat.st_mtime_ns}" for stat in stats)
+
+    return f"{key}-{PATTERN_CACHE_VERSION}"
+
+
+def build_pattern_bundle(pid: str, bundle_hash: str) -> dict:
+    """
+    the segments of a pattern projected to PROJ and its stops as x/y in PROJ,
+    with the columns the stop time calculation uses
+    """
+
+    segments_gdf = pattern_opener(pid, "segment").to_crs(PROJ)
+    segments_gdf["prev_segment"] = segments_gdf["segments"]
+    segments_gdf["segment"] = segments_gdf["segments"] + 1
+    segments_gdf = segments_gdf[["prev_segment", "segment", "geometry"]]
+
+    stops_gdf = pattern_opener(pid, "stop").to_crs(PROJ)
+    stops_df = pd.DataFrame(
+        {
+            "seg_combined": stops_gdf["segment"],
+            "typ": stops_gdf["typ"],
+            "stpid": stops_gdf["stpid"],
+            "p_stp_id": stops_gdf["p_stp_id"],
+            "x": stops_gdf.geometry.x,
+            "y": stops_gdf.geometry.y,
+            "data_time": None,
+        }
+    )
+
+    return {"hash": bundle_hash, "segments": segments_gdf, "stops": stops_df}
+
+
+@lru_cache(maxsize=PATTERN_CACHE_SIZE)
+def load_pattern_bundle(pid: str, bundle_hash: str) -> dict:
+    """
+    the pattern bundle stored in patterns_cache, rebuilt and stored again if
+    it was made from another version of the pattern or can't be read
+    """
+
+    cache_dir = f"{DIR}/patterns/patterns_cache"
+    segments_path = f"{cache_dir}/pid_{pid}_segments.parquet"
+    stops_path = f"{cache_dir}/pid_{pid}_stops.parquet"
+
+    # the stops are written last and carry the hash of the bundle
+    if os.path.exists(stops_path):
+        try:
+            stops_df = pd.read_parquet(stops_path)
+            if stops_df.attrs.get("hash") == bundle_hash:
+                segments_gdf = gpd.read_parquet(segments_path)
+                return {
+                    "hash": bundle_hash,
+                    "segments": segments_gdf,
+                    "stops": stops_df,
+                }
+        except Exception as e:
+            logging.warning(f"Could not read cached pattern {pid}, rebuilding: {e}")
+
+    logging.debug(f"Caching pattern {pid}")
+    bundle = build_pattern_bundle(pid, bundle_hash)
+
+    # write then rename, workers may read the pattern at the same time
+    os.makedirs(cache_dir, exist_ok=True)
+    bundle["stops"].attrs["hash"] = bundle_hash
+    bundle["segments"].to_parquet(f"{segments_path}.{os.getpid()}")
+    os.replace(f"{segments_path}.{os.getpid()}", segments_path)
+    bundle["stops"].to_parquet(f"{stops_path}.{os.getpid()}", index=False)
+    os.replace(f"{stops_path}.{os.getpid()}", stops_path)
+
+    return bundle
+
+
+def pattern_bundle(pid: str) -> dict:
+    """
+    the segments and stops of a pattern ready for the stop time calculation,
+    projected to PROJ. Bundles are kept on disk and the last
+    PATTERN_CACHE_SIZE in memory, both until the pattern is rebuilt
+    """
+
+    return load_pattern_bundle(pid, pattern_hash(pid))
 
 
 # End -------------------------------------------------------------------------
@@ -1,5 +1,9 @@
-import json
 import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable
 from datetime import date, timedelta
 from pathlib import Path
 
@@ -8,10 +12,21 @@ import pandas as pd
 import polars as pl
 import requests
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
 from utils import process_logger
 
 STAGING_PATH = "data/staging"
 RAW_PATH = "data/raw_trips/"
+FULL_DAY_URL = "gs://miurban-dj-public/cta-stop-watch/full_day_data/"
+PATTERN_API_URL = "http://www.ctabustracker.com/bustime/api/v2/getpatterns"
+
+# Bus Tracker API limits: pids per getpatterns call and calls per day per key
+PIDS_PER_REQUEST = 10
+DAILY_REQUEST_LIMIT = 10_000
+REQUESTS_PER_SECOND = 5
+
+# responses of the Bus Tracker API worth trying again
+RETRY_STATUSES = [429, 500, 502, 503, 504]
 
 dtype_map = {
     "vid": pl.UInt32,
@@ -34,6 +49,12 @@ dtype_map = {
     "data_date": pl.Utf8,
 }
 
+# typed columns of the parquet files, pid and data_time come in as text
+column_types = [
+    pl.col("pid").cast(pl.Int32, strict=False),
+    pl.col("data_time").str.to_datetime("%Y-%m-%d %H:%M:%S", strict=False),
+]
+
 
 def get_date_range(start: date, end: date, delta: timedelta):
     cur_date = start
@@ -42,53 +63,109 @@ def get_date_range(start: date, end: date, delta: timedelta):
         cur_date += delta
 
 
-def download_full_day_csv_to_parquet(start: date, end: date, delta: timedelta):
+def download_day(day: date, source: str, retries: int, backoff: float) -> str:
     """
-    Download full day data from the CTA API and save as parquet
+    Stream one full day csv from source into a parquet file in raw and link
+    it into staging. Retries with exponential backoff before giving up.
+    """
+
+    day_f = day.strftime("%Y-%m-%d")
+    day_parquet = day_f + ".parquet"
+    url_day = f"{source.rstrip('/')}/{day_f}.csv"
+
+    raw_file = RAW_PATH + day_parquet
+    for attempt in range(retries + 1):
+        try:
+            # stream the csv straight into parquet, the day is never in memory
+            (
+                pl.scan_csv(url_day, schema_overrides=dtype_map)
+                .with_columns(column_types)
+                .sink_parquet(raw_file)
+            )
+            break
+        except Exception as e:
+            # don't leave a partial file that would be skipped on the next run
+            Path(raw_file).unlink(missing_ok=True)
+            if attempt == retries:
+                raise
+            wait = backoff * 2**attempt
+            process_logger.debug(
+                f"Attempt {attempt + 1} to download {day_f} failed: {e}. Retrying in {wait}s"
+            )
+            time.sleep(wait)
+
+    # staging gets a hard link to the same file, copy if links are not possible
+    staging_file = f"{STAGING_PATH}/days/{day_parquet}"
+    Path(staging_file).unlink(missing_ok=True)
+    try:
+        os.link(raw_file, staging_file)
+    except OSError:
+        shutil.copyfile(raw_file, staging_file)
+
+    return day_f
+
+
+def download_full_day_csv_to_parquet(
+    start: date,
+    end: date,
+    delta: timedelta,
+    source: str = FULL_DAY_URL,
+    workers: int = 8,
+    retries: int = 3,
+    backoff: float = 2,
+):
     """
-    URL_HEAD = "gs://miurban-dj-public/cta-stop-watch/full_day_data/"
+    Download full day data from the CTA API and save as parquet
 
-    # TODO update paths
-    out_staging_path = f"{STAGING_PATH}/days/"
+    Days are downloaded concurrently by up to workers threads. source is the
+    folder with the YYYY-MM-DD.csv files, the bucket by default, but a local
+    directory works too.
+    """
 
     os.makedirs(RAW_PATH, exist_ok=True)
+    os.makedirs(f"{STAGING_PATH}/days/", exist_ok=True)
 
     failed = []
     success = []
 
+    days = []
     for day in get_date_range(start, end, delta):
         day_f = day.strftime("%Y-%m-%d")
-        day_csv = day_f + ".csv"
-        day_parquet = day_f + ".parquet"
-        url_day = URL_HEAD + day_csv
-        if Path(RAW_PATH + day_parquet).exists():
+        if Path(RAW_PATH + day_f + ".parquet").exists():
             process_logger.info(f"Skipping {day_f} as it already exists")
             continue
-
-        try:
-            df = pl.read_csv(url_day, dtypes=dtype_map)
-            success.append(day_f)
-            # save file
-            df.write_parquet(RAW_PATH + day_parquet)
-
-            # save for staging
-            df.write_parquet(out_staging_path + day_parquet)
-        except Exception as e:
-            process_logger.error(f"Failed to download {day_f}: {e}")
-            failed.append(day_f)
+        days.append(day)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(download_day, day, source, retries, backoff): day
+            for day in days
+        }
+        for future in as_completed(futures):
+            day_f = futures[future].strftime("%Y-%m-%d")
+            try:
+                success.append(future.result())
+            except Exception as e:
+                process_logger.error(f"Failed to download {day_f}: {e}")
+                failed.append(day_f)
+
+    success.sort()
+    failed.sort()
 
     return success, failed
 
 
 def save_partitioned_parquet(in_folder, out_file: str):
     """
-    create one big parquet file with a unique trip id for all downloaded days
+    create one big parquet file with a unique trip id for all downloaded days.
+    pid is stored as an integer but goes in the id as a double to keep the
+    format of the trip ids already processed
     """
     cmd_number = f"""COPY
     (SELECT
         *,
         CONCAT(
-            rt, pid, tatripid, vid, data_date
+            rt, CAST(pid AS DOUBLE), tatripid, vid, data_date
         ) AS unique_trip_vehicle_day
     FROM read_parquet('{in_folder}/*.parquet'))
     TO '{out_file}'
@@ -96,9 +173,12 @@ def save_partitioned_parquet(in_folder, out_file: str):
     duckdb.execute(cmd_number)
 
 
-def full_download(start: str = "2023-1-1", end: str = "2024-12-31"):
+def full_download(
+    start: str = "2023-1-1", end: str = "2024-12-31", source: str = FULL_DAY_URL
+):
     """
     download full days from start to end, then save them and log results.
+    source can be a local directory with the same YYYY-MM-DD.csv files.
     """
 
     start = start.split("-")
@@ -107,7 +187,7 @@ def full_download(start: str = "2023-1-1", end: str = "2024-12-31"):
     end = date(year=int(end[0]), month=int(end[1]), day=int(end[2]))
 
     delta = timedelta(days=1)
-    success, failed = download_full_day_csv_to_parquet(start, end, delta)
+    success, failed = download_full_day_csv_to_parquet(start, end, delta, source)
 
     # log success and failed TODO
     process_logger.info(f"Downloaded {len(success)} day(s): {success}")
@@ -133,60 +213,199 @@ def extract_list_pids():
     df_routes.collect().write_parquet(f"{STAGING_PATH}/all_pids_list.parquet")
 
 
-def extract_pid(pid: int):
+def extract_routes():
     """
-    convert days into one file per pid
+    Grab all pids from current data download and separate them into individual folders for each pid
+
+    All the pids are written in one scan of the download, partitioned as
+    staging/pids/pid=<pid>/*.parquet with pid stored as an integer.
     """
-    df = pl.scan_parquet(f"{STAGING_PATH}/current_days_download.parquet")
-    df_route = df.filter(pl.col("pid").cast(pl.Int32, strict=False) == pid)
-    df_route.sink_parquet(f"{STAGING_PATH}/pids/{pid}.parquet")
 
+    extract_list_pids()
+
+    cmd_partition = f"""COPY
+    (SELECT
+        * REPLACE (TRY_CAST(pid AS INTEGER) AS pid)
+    FROM read_parquet('{STAGING_PATH}/current_days_download.parquet')
+    WHERE TRY_CAST(pid AS INTEGER) IS NOT NULL)
+    TO '{STAGING_PATH}/pids'
+    (FORMAT 'parquet', PARTITION_BY (pid), OVERWRITE_OR_IGNORE true);"""
+    duckdb.execute(cmd_partition)
 
-def extract_routes():
-    """
-    Grab all pids from current data download and separate them into individual files for each pid
 
+def rate_limiter(
+    per_second: float, limit: int = DAILY_REQUEST_LIMIT
+) -> Callable[[], None]:
+    """
+    returns a function to call before each request. It blocks until the next
+    of per_second evenly spaced slots, shared by all the threads that call
+    it, and raises once limit requests were made
     """
 
-    extract_list_pids()
-    all_pids_df = pl.read_parquet(f"{STAGING_PATH}/all_pids_list.parquet")
+    lock = threading.Lock()
+    next_slot = [time.monotonic()]
+    made = [0]
+
+    def wait() -> None:
+        with lock:
+            if made[0] >= limit:
+                raise RuntimeError(f"Reached the limit of {limit} requests")
+            made[0] += 1
+            now = time.monotonic()
+            slot = max(now, next_slot[0])
+            next_slot[0] = slot + 1 / per_second
+        time.sleep(slot - now)
 
-    for row in all_pids_df.iter_rows(named=True):
-        extract_pid(row["pid"])
+    return wait
 
 
-def query_cta_api(pid: str, out_path) -> bool | pd.DataFrame:
+def pattern_session(workers: int) -> requests.Session:
+    """
+    http session with a connection for each worker. It doesn't retry, see
+    request_patterns, so every request made goes through the rate limiter
     """
-    Takes a route pattern ID and queries the CTA API to get the raw pattern
-    data (in lat, lon format) and returns a standardized data frame for further
-    cleaning.
 
-    Input:
-        - pid (str): The pattern id to call from the CTA API
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers, max_retries=0)
 
-    Output:
-        - pattern (data frame): A data frame with standardized names
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
 
+
+def request_patterns(
+    session: requests.Session,
+    wait: Callable[[], None],
+    pids: list[str],
+    out_path: str,
+    api_url: str,
+    api_key: str,
+    retries: int = 3,
+    backoff: float = 1,
+) -> list[str]:
+    """
+    get the raw patterns of up to PIDS_PER_REQUEST pids in one getpatterns
+    call and write each to out_path. Throttled, server and connection errors
+    are retried with exponential backoff, each attempt waiting on the rate
+    limiter. Returns the pids that were written
     """
-    # Make call to API for given pid and obtain pattern point data
 
-    load_dotenv()
+    for attempt in range(retries + 1):
+        wait()
+        try:
+            response = session.get(
+                api_url,
+                params={"format": "json", "key": api_key, "pid": ",".join(pids)},
+                timeout=30,
+            )
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == retries:
+                raise
+        else:
+            if response.status_code not in RETRY_STATUSES or attempt == retries:
+                break
+        time.sleep(backoff * 2**attempt)
+
+    response.raise_for_status()
+    patterns = response.json()["bustime-response"]
+
+    for error in patterns.get("error", []):
+        process_logger.debug(f"No pattern for {error.get('pid')}: {error.get('msg')}")
+
+    found = []
+    for pattern in patterns.get("ptr", []):
+        pid = str(pattern["pid"])
+        df_pattern = pd.DataFrame(pattern["pt"])
+        df_pattern.to_parquet(f"{out_path}/pid_{pid}_raw.parquet")
+        found.append(pid)
+
+    return found
+
+
+def fetch_patterns(
+    pids: list[str],
+    out_path: str,
+    workers: int = 4,
+    api_url: str = PATTERN_API_URL,
+    api_key: str | None = None,
+    per_second: float = REQUESTS_PER_SECOND,
+) -> tuple[list[str], list[str]]:
+    """
+    download the raw patterns of pids from the Bus Tracker API to out_path.
+
+    Pids with a raw pattern already in out_path are skipped. The rest are
+    requested PIDS_PER_REQUEST at a time by up to workers threads sharing one
+    session, at most per_second requests a second. At most DAILY_REQUEST_LIMIT
+    requests, retries included, are made in each run: requests made by other
+    runs the same day are not counted. api_url can point to a stand-in server,
+    see benchmarks.pattern_server. Returns the pids found and the ones that
+    failed
+    """
 
-    BUS_API_KEY = os.environ["BUS_API_KEY"]
+    if api_key is None:
+        load_dotenv()
+        api_key = os.environ["BUS_API_KEY"]
+
+    os.makedirs(out_path, exist_ok=True)
+
+    found = []
+    missing = []
+    for pid in pids:
+        if os.path.exists(f"{out_path}/pid_{pid}_raw.parquet"):
+            process_logger.info(f"Skipping PID {pid} as it already exists")
+            found.append(pid)
+        else:
+            missing.append(pid)
+
+    batches = [
+        missing[i : i + PIDS_PER_REQUEST]
+        for i in range(0, len(missing), PIDS_PER_REQUEST)
+    ]
+    if len(batches) > DAILY_REQUEST_LIMIT:
+        process_logger.error(
+            f"{len(batches)} pattern requests are over the daily limit, only making {DAILY_REQUEST_LIMIT}"
+        )
+        batches = batches[:DAILY_REQUEST_LIMIT]
+
+    wait = rate_limiter(per_second, DAILY_REQUEST_LIMIT)
+    with pattern_session(workers) as session:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(
+                    request_patterns, session, wait, batch, out_path, api_url, api_key
+                ): batch
+                for batch in batches
+            }
+            for future in as_completed(futures):
+                try:
+                    found += future.result()
+                except Exception as e:
+                    process_logger.error(
+                        f"Error downloading patterns {futures[future]}: {e}"
+                    )
+
+    failed = sorted(set(pids) - set(found))
+    process_logger.info(
+        f"Downloaded {len(found)} pattern(s) in {len(batches)} batch(es), {len(failed)} failed"
+    )
 
-    if os.path.exists(out_path + "/patterns_raw/pid_" + pid + "_raw.parquet"):
-        process_logger.info(f"Skipping PID {pid} as it already exists")
+    return found, failed
 
-    url = f"http://www.ctabustracker.com/bustime/api/v2/getpatterns?format=json&key={BUS_API_KEY}&pid={pid}"
-    response = requests.get(url)
-    pattern = json.loads(response.content)
 
-    # if "error" in pattern["bustime-response"]:
-    #     logging.debug("\t\t\t Skiping PID {pid}")
-    #     return False
+def query_cta_api(pid: str, out_path) -> bool:
+    """
+    Takes a route pattern ID and queries the CTA API to get the raw pattern
+    data (in lat, lon format) and saves it in out_path, see fetch_patterns.
 
-    df_pattern = pd.DataFrame(pattern["bustime-response"]["ptr"][0]["pt"])
+    Input:
+        - pid (str): The pattern id to call from the CTA API
+
+    Output:
+        - A boolean indicating if the pattern was found
+
+    """
 
-    df_pattern.to_parquet(f"{out_path}/pid_{pid}_raw.parquet")
+    found, _ = fetch_patterns([pid], out_path, workers=1)
 
-    return True
+    return pid in found
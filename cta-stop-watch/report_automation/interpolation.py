@@ -4,170 +4,161 @@ import numpy as np
 # Functions -------------------------------------------------------------------
 
 
-def interpolate_stoptime(trip_df: pd.DataFrame) -> pd.DataFrame:
+def interpolate_stoptime(trip_df: pd.DataFrame) -> tuple[pd.DataFrame, list]:
     """
     given a route df with stops and bus location, interpolate the time when the bus is at each stop
-    """
 
-    trip_df = trip_df.to_crs("epsg:26971")
+    trip_df can hold any number of trips. Rows of each unique_trip_vehicle_day
+    must be together and in route order, every step is done per trip with
+    grouped operations so a whole pattern is interpolated at once. Positions
+    are the planar x/y in meters from calculate_stop_time. Returns the stops
+    df and the list of trips that could not be interpolated.
+    """
 
-    trip_df.loc[:, "data_time"] = pd.to_datetime(
-        trip_df["data_time"], format="%Y-%m-%d %H:%M:%S", errors="coerce"
+    # plain columnar frame, one row per stop or bus location
+    df = pd.DataFrame(
+        {
+            "seg_combined": trip_df["seg_combined"].to_numpy(),
+            "typ": trip_df["typ"].to_numpy(),
+            "data_time": pd.to_datetime(
+                trip_df["data_time"], format="%Y-%m-%d %H:%M:%S", errors="coerce"
+            ).to_numpy(),
+            "unique_trip_vehicle_day": trip_df["unique_trip_vehicle_day"].to_numpy(),
+            "stpid": trip_df["stpid"].to_numpy(),
+            "p_stp_id": trip_df["p_stp_id"].to_numpy(),
+        }
     )
+    trip = pd.Series(pd.factorize(df["unique_trip_vehicle_day"])[0])
 
-    trip_df["b_value"] = (trip_df["typ"] == "B").cumsum()
-    trip_df["b_value"] = trip_df["b_value"].ffill()
+    is_stop = df["typ"] == "S"
+    is_ping = df["data_time"].notna()
 
-    trip_df["s_value"] = (trip_df["typ"] == "S").cumsum()
-    trip_df["s_value"] = trip_df["s_value"].ffill()
+    df["b_value"] = (df["typ"] == "B").groupby(trip).cumsum()
+    df["s_value"] = is_stop.groupby(trip).cumsum()
 
-    # start_loop_end = time.time()
+    # distance to the next row of the same trip
+    x = trip_df["x"].to_numpy()
+    y = trip_df["y"].to_numpy()
+    dx = np.diff(x, append=np.nan)
+    dy = np.diff(y, append=np.nan)
+    dist_next = np.sqrt(dx * dx + dy * dy)
+    dist_next[np.append(trip.to_numpy()[1:] != trip.to_numpy()[:-1], True)] = np.nan
+    df["dist_next"] = dist_next
 
-    trip_df["dist_next"] = trip_df["geometry"].distance(trip_df["geometry"].shift(-1))
+    ping_groups = [trip, df["b_value"]]
 
     # Calculate accumulated distance
-    trip_df["accumulated_distance"] = trip_df.groupby("b_value")["dist_next"].cumsum()
+    df["accumulated_distance"] = df.groupby(ping_groups)["dist_next"].cumsum()
 
     # calculates 'ping_dist' based on 'b_value' groups
-    trip_df["ping_dist"] = trip_df.groupby("b_value")["dist_next"].transform("sum")
+    df["ping_dist"] = df.groupby(ping_groups)["dist_next"].transform("sum")
 
     # calculates 'stop_dist' based on 's_value' groups
-    trip_df["stop_dist"] = trip_df.groupby("s_value")["dist_next"].transform("sum")
-
-    trip_df["stop_sequence"] = trip_df["s_value"]
-
-    ping_times_df = trip_df.loc[
-        trip_df.data_time.notna(),
-        [
-            "seg_combined",
-            "stop_sequence",
-            "data_time",
-            "b_value",
-            "typ",
-            "unique_trip_vehicle_day",
-        ],
-    ]
-    ping_times_df.loc[:, "ping_time_diff"] = -1 * ping_times_df.data_time.diff(-1)
+    df["stop_dist"] = df.groupby([trip, df["s_value"]])["dist_next"].transform("sum")
 
-    # merge the two dataframes to include the 'ping_time_diff' column in trip_df
-    trip_df = trip_df.merge(ping_times_df, on="b_value", how="left")
-
-    # replaces NaN values in data_time_y and ping_time_diff for calculation
-    trip_df["data_time_y"] = trip_df["data_time_y"].fillna(0)
-    trip_df["ping_time_diff"] = trip_df["ping_time_diff"].fillna(0)
-
-    # converts to datetime
-    trip_df["data_time_y"] = pd.to_datetime(
-        trip_df["data_time_y"], format="%Y-%m-%d %H:%M:%S", errors="coerce"
+    # time of the ping that opens each 'b_value' group and time to the next ping
+    ping_time_diff = pd.Series(pd.NaT, index=df.index, dtype="timedelta64[ns]")
+    ping_time_diff[is_ping] = (
+        df.loc[is_ping, "data_time"].groupby(trip[is_ping]).shift(-1)
+        - df.loc[is_ping, "data_time"]
+    )
+    df["ping_time_diff"] = ping_time_diff
+    df["ping_time"] = df.groupby(ping_groups)["data_time"].transform("first")
+    df["ping_time_diff"] = (
+        df.groupby(ping_groups)["ping_time_diff"]
+        .transform("first")
+        .fillna(pd.Timedelta(0))
     )
-    trip_df["ping_time_diff"] = pd.to_timedelta(trip_df["ping_time_diff"])
 
     # calculates times at each bus stop
-    stops_df = trip_df.loc[trip_df["typ_x"].isin(["S"])].copy()
-    stops_df["original_index"] = stops_df.index
-    stops_df.reset_index(drop=True, inplace=True)
+    stops_df = df.loc[is_stop].copy()
+    stop_trip = trip[is_stop]
 
-    stops_df["bus_stop_time"] = stops_df["data_time_y"] + (
+    stops_df["bus_stop_time"] = stops_df["ping_time"] + (
         stops_df["ping_time_diff"]
         * stops_df["accumulated_distance"]
         / stops_df["ping_dist"].replace(0, 0)
     )
 
     # calculate the speed in meters per second then to mph
-    stops_df["time_diff_seconds"] = stops_df["ping_time_diff"].apply(
-        lambda x: x.total_seconds()
-    )
+    stops_df["time_diff_seconds"] = stops_df["ping_time_diff"].dt.total_seconds()
     stops_df["time_diff_seconds"] = stops_df["time_diff_seconds"].replace(0, 1e-9)
     stops_df["speed_mph"] = (stops_df["ping_dist"] / 1609) / (
         stops_df["time_diff_seconds"] / 3600
     )
 
-    stops_df = stops_df[
-        [
-            "original_index",
-            "seg_combined_x",
-            "typ_x",
-            "stop_sequence_x",
-            "bus_stop_time",
-            "time_diff_seconds",
-            "stop_dist",
-            "speed_mph",
-            "unique_trip_vehicle_day_x",
-            "stpid",
-            "p_stp_id",
-        ]
-    ]
-
-    new_names = {
-        "seg_combined_x": "seg_combined",
-        "typ_x": "typ",
-        "unique_trip_vehicle_day_x": "unique_trip_vehicle_day",
-        "stop_sequence_x": "stop_sequence",
-    }
-
-    stops_df.rename(columns=new_names, inplace=True)
-
     # replace values below 1 or above 115 for speed_mph
-    stops_df["speed_mph"] = stops_df["speed_mph"].apply(
-        lambda x: np.nan if x < 1 or x > 115 else x
+    stops_df["speed_mph"] = stops_df["speed_mph"].mask(
+        (stops_df["speed_mph"] < 1) | (stops_df["speed_mph"] > 115)
     )
-    stops_df["speed_mph"] = stops_df["speed_mph"].fillna(method="ffill")
-    stops_df["speed_mph"] = stops_df["speed_mph"].fillna(method="bfill")
+    stops_df["speed_mph"] = stops_df["speed_mph"].groupby(stop_trip).ffill()
+    stops_df["speed_mph"] = stops_df["speed_mph"].groupby(stop_trip).bfill()
 
     # replace values below 1 for distance
-    stops_df["stop_dist"] = stops_df["stop_dist"].apply(
-        lambda x: np.nan if x < 1 else x
-    )
-    stops_df["stop_dist"] = stops_df["stop_dist"].fillna(method="ffill")
+    stops_df["stop_dist"] = stops_df["stop_dist"].mask(stops_df["stop_dist"] < 1)
+    stops_df["stop_dist"] = stops_df["stop_dist"].groupby(stop_trip).ffill()
 
     # update time_diff column based on the new time_diff_seconds calculation
     stops_df["time_diff_seconds"] = stops_df["stop_dist"] / (
         stops_df["speed_mph"] / 2.23694
     )
 
-    stops_df.set_index("original_index", inplace=True)
-    new_trip_df = pd.concat([stops_df, ping_times_df], axis=0, sort=False)
-    new_trip_df.sort_index(inplace=True)
-    new_trip_df.reset_index(drop=True, inplace=True)
+    # recalculate bus_stop_time for stops before the first and after the last ping
+    edges_df = df.loc[is_stop | is_ping, ["data_time"]]
+    edges_df["is_ping"] = is_ping[is_stop | is_ping]
+    edges_df["time_diff_seconds"] = stops_df["time_diff_seconds"]
+    edge_trip = trip[is_stop | is_ping]
+
+    pings_before = edges_df["is_ping"].groupby(edge_trip).cumsum()
+    pings_total = edges_df["is_ping"].groupby(edge_trip).transform("sum")
+    first_rows = pings_before == 0
+    last_rows = (pings_before == pings_total) & ~edges_df["is_ping"]
+
+    # trips without pings or with a missing step at the edges can't be walked
+    missing_step = edges_df["time_diff_seconds"].isna() & (first_rows | last_rows)
+    bad_trips = (missing_step | (pings_total == 0)).groupby(edge_trip).any()
+    bad_trip_ids = (
+        df["unique_trip_vehicle_day"]
+        .drop_duplicates()
+        .to_numpy()[bad_trips[bad_trips].index]
+    )
 
-    # recalculate bus_stop_time for first and last rows
-    first_ping_index = new_trip_df.loc[new_trip_df["data_time"].notna()].index[0]
-    last_ping_index = new_trip_df.loc[new_trip_df["data_time"].notna()].index[-1]
+    # whole nanoseconds per step, the same as adding pd.Timedelta(seconds=...)
+    step_ns = (edges_df["time_diff_seconds"] * 1e9).fillna(0).astype("int64")
 
-    new_trip_df.loc[first_ping_index, "bus_stop_time"] = new_trip_df.loc[
-        first_ping_index, "data_time"
-    ]
-    new_trip_df.loc[last_ping_index, "bus_stop_time"] = new_trip_df.loc[
-        last_ping_index, "data_time"
-    ]
+    # first rows, walking back from the first ping
+    first_ping_time = edges_df.groupby(edge_trip)["data_time"].transform("first")
+    back_ns = step_ns.where(first_rows, 0)[::-1].groupby(edge_trip[::-1]).cumsum()
+    first_times = first_ping_time - pd.to_timedelta(back_ns[::-1], unit="ns")
 
-    # first rows
-    for i in range(first_ping_index - 1, -1, -1):
-        new_trip_df.loc[i, "bus_stop_time"] = new_trip_df.loc[
-            i + 1, "bus_stop_time"
-        ] - pd.Timedelta(seconds=new_trip_df.loc[i, "time_diff_seconds"])
+    # last rows, walking forward from the last ping
+    last_ping_time = edges_df.groupby(edge_trip)["data_time"].transform("last")
+    forward_ns = step_ns.where(last_rows, 0).groupby(edge_trip).cumsum()
+    last_times = last_ping_time + pd.to_timedelta(forward_ns, unit="ns")
 
-    # last rows
-    for i in range(last_ping_index + 1, len(new_trip_df)):
-        new_trip_df.loc[i, "bus_stop_time"] = new_trip_df.loc[
-            i - 1, "bus_stop_time"
-        ] + pd.Timedelta(seconds=new_trip_df.loc[i, "time_diff_seconds"])
+    stops_df.loc[first_rows[first_rows].index, "bus_stop_time"] = first_times[
+        first_rows
+    ]
+    stops_df.loc[last_rows[last_rows].index, "bus_stop_time"] = last_times[last_rows]
+    stops_df = stops_df[~stop_trip.isin(bad_trips[bad_trips].index)]
 
     # clean data table
-    new_trip_df = new_trip_df.drop(
-        columns=[
-            "b_value",
-            "ping_time_diff",
-            "time_diff_seconds",
-            "data_time",
-            "stop_dist",
+    stops_df = stops_df.rename(columns={"s_value": "stop_sequence"})
+    new_trip_df = stops_df[
+        [
+            "seg_combined",
+            "typ",
+            "stop_sequence",
+            "bus_stop_time",
+            "speed_mph",
+            "unique_trip_vehicle_day",
+            "stpid",
+            "p_stp_id",
         ]
-    )
-
-    new_trip_df = new_trip_df[new_trip_df["typ"] == "S"]
+    ].reset_index(drop=True)
 
     new_trip_df["bus_stop_time"] = pd.to_datetime(
         new_trip_df["bus_stop_time"], format="%Y-%m-%d %H:%M:%S", errors="coerce"
     )
 
-    return new_trip_df
+    return new_trip_df, list(bad_trip_ids)
@@ -1,6 +1,9 @@
 from process_metrics import process_metrics
 from process_trips import process_new_trips
+from update_metrics import MEMORY_LIMIT, compact_processed_trips
 from utils import create_config, metrics_logger
+from metrics_utils import SKETCH_ACCURACY
+from telemetry import summary_report
 import argparse
 
 
@@ -28,10 +31,56 @@ def parse_arguments() -> argparse.Namespace:
         "--pipeline_step",
         type=str,
         nargs="+",
-        choices=["process", "metrics", "local", "remote"],
+        choices=["process", "metrics", "local", "remote", "compact", "report"],
         help="Specify which part of the pipeline to run",
     )
 
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of processes for stop times or route metrics (default: all cores)",
+    )
+
+    parser.add_argument(
+        "-f",
+        "--force_patterns",
+        action="store_true",
+        help="Rebuild all the patterns, even the ones that did not change",
+    )
+
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        action="store_true",
+        help="Only recalculate metrics for the routes and months that changed",
+    )
+
+    parser.add_argument(
+        "-s",
+        "--sketch",
+        type=float,
+        nargs="?",
+        const=SKETCH_ACCURACY,
+        default=None,
+        help="Take quantiles from sketches with this relative accuracy instead of exact",
+    )
+
+    parser.add_argument(
+        "-m",
+        "--memory",
+        action="store_true",
+        help="Log the peak memory of updating the metrics",
+    )
+
+    parser.add_argument(
+        "--memory_limit",
+        type=str,
+        default=MEMORY_LIMIT,
+        help=f"Memory duckdb can use to combine route metrics (default: {MEMORY_LIMIT})",
+    )
+
     args = parser.parse_args()
     return args
 
@@ -46,14 +95,33 @@ if __name__ == "__main__":
         create_config()
     elif args.pipeline_step[0] == "process":
         print("Processing new trips")
-        process_new_trips()
+        process_new_trips(workers=args.workers, force_patterns=args.force_patterns)
     elif args.pipeline_step[0] == "metrics":
         if args.pipeline_step[1] == "local":
-            process_metrics(local=True)
+            process_metrics(
+                local=True,
+                incremental=args.incremental,
+                sketch_accuracy=args.sketch,
+                workers=args.workers,
+                memory_limit=args.memory_limit,
+                sample_memory=args.memory,
+            )
         elif args.pipeline_step[1] == "remote":
             try:
-                process_metrics(local=False)
+                process_metrics(
+                    local=False,
+                    incremental=args.incremental,
+                    sketch_accuracy=args.sketch,
+                    workers=args.workers,
+                    memory_limit=args.memory_limit,
+                    sample_memory=args.memory,
+                )
             except Exception as e:
                 metrics_logger.error(f"Error: {e}")
+    elif args.pipeline_step[0] == "compact":
+        print("Compacting processed trips")
+        compact_processed_trips()
+    elif args.pipeline_step[0] == "report":
+        summary_report()
 
 # End -------------------------------------------------------------------------
@@ -1,6 +1,9 @@
 import polars as pl
 import pandas as pd
 import pathlib
+import math
+import os
+from glob import glob
 from utils import metrics_logger
 from datetime import date, timedelta
 
@@ -8,255 +11,583 @@ from datetime import date, timedelta
 
 # Paths
 DIR = pathlib.Path(__file__).parent / "data"
+CHANGES_FILE = DIR / "metrics" / "changed_partitions.parquet"
+SKETCH_DIR = DIR / "metrics" / "sketches"
+
+# periods over all the history and periods bounded by a year or a month
+ALL_TIME_PERIODS = ["hour", "weekday", "month"]
+YEAR_PERIODS = ["year", "year_hour", "year_weekday"]
+MONTH_PERIODS = ["month_abs", "last_full_month"]
+
+# sketches, default relative accuracy of the quantiles and offset that keeps
+# the bucket of every value other than 0 positive before the sign is applied
+SKETCH_ACCURACY = 0.01
+SKETCH_OFFSET = 2**15
 
 # Functions -------------------------------------------------------------------
 
 
-def create_trips_df(rt: str, is_schedule: bool = False) -> pl.DataFrame:
+def processed_trip_files(pid: str, months: list[date] | None = None) -> list[str]:
     """
-    Given rts to pids xwalk and a list of rts, create a df for all the trips for the rts
+    list the files with processed trips for a pid. Trips are appended as
+    processed_by_pid/pid={pid}/date=YYYY-MM/part-*.parquet, older data can
+    still be in processed_by_pid/trips_{pid}_full.parquet until compacted.
+    Only the files of months are listed if given
     """
 
-    trips = []
-    xwalk = pd.read_parquet(f"{DIR}/rt_to_pid.parquet")
-
-    # just look at the rts for schedule
-    if is_schedule:
-        iter = [rt]
-        file_DIR = f"{DIR}/clean_timetables/rt{rt}_timetable.parquet"
-        error = "Do not have timetable for route {rt}. Skipping"
+    if months is None:
+        files = sorted(glob(f"{DIR}/processed_by_pid/pid={pid}/*/*.parquet"))
     else:
-        data_set = xwalk[xwalk["rt"] == rt].groupby(["rt", "pid"]).count().reset_index()
-        pids = data_set.itertuples(index=False)
-        iter = pids
+        files = []
+        for month in months:
+            files += sorted(
+                glob(f"{DIR}/processed_by_pid/pid={pid}/date={month:%Y-%m}/*.parquet")
+            )
 
-        file_DIR = str(DIR) + "/processed_by_pid/trips_{pid}_full.parquet"
-        error = "Do not have pattern {pid} for route. Skipping"
+    legacy_file = f"{DIR}/processed_by_pid/trips_{pid}_full.parquet"
+    if os.path.exists(legacy_file):
+        files.append(legacy_file)
 
-    for obj in iter:
-        if is_schedule:
-            rt = obj
-            template_values = {"rt": rt}
+    return files
 
-        else:
-            rt, pid = obj.rt, obj.pid
-            template_values = {"pid": pid}
 
-        try:
-            df_trips = pl.read_parquet(file_DIR.format(**template_values))
-        except FileNotFoundError:
-            metrics_logger.debug(error.format(**template_values))
-            continue
+def read_processed_trips(pid: str, months: list[date] | None = None) -> pl.DataFrame:
+    """
+    read all the processed trips for a pid into one df, see processed_trip_files
+    """
 
-        if "stop_dist" in df_trips.columns:
-            df_trips = df_trips.drop("stop_dist")
+    files = processed_trip_files(pid, months)
+    if not files:
+        raise FileNotFoundError(f"No processed trips for pattern {pid}")
 
-        df_trips = df_trips.with_columns(pl.exclude("bus_stop_time").cast(pl.String))
+    return pl.concat([pl.read_parquet(f) for f in files], how="diagonal_relaxed")
 
-        df_trips = df_trips.with_columns(
-            pl.col("pid").cast(pl.Float64).cast(pl.Int32).cast(pl.String).alias("pid")
+
+def scan_processed_trips(pid: str, months: list[date] | None = None) -> pl.LazyFrame:
+    """
+    lazily scan the processed trips of a pid with only the columns the stop
+    metrics need, see processed_trip_files. Ids are kept as compact types
+    """
+
+    files = processed_trip_files(pid, months)
+    if not files:
+        raise FileNotFoundError(f"No processed trips for pattern {pid}")
+
+    scans = []
+    for file in files:
+        trips_lf = pl.scan_parquet(file).select(
+            pl.col("rt").cast(pl.String).cast(pl.Categorical),
+            pl.col("pid").cast(pl.Float64).cast(pl.Int32),
+            pl.col("stpid").cast(pl.String).cast(pl.Categorical).alias("stop_id"),
+            pl.col("unique_trip_vehicle_day")
+            .cast(pl.String)
+            .cast(pl.Categorical)
+            .alias("trip_id"),
+            pl.col("bus_stop_time").cast(pl.Datetime),
         )
 
-        # convert bus_stop_time to nanoseconds
-        df_trips = df_trips.with_columns(pl.col("bus_stop_time").cast(pl.Datetime))
+        # pushed down into the scan, legacy files hold every month
+        if months is not None:
+            trips_lf = trips_lf.filter(
+                pl.col("bus_stop_time").dt.truncate("1mo").dt.date().is_in(months)
+            )
 
-        trips.append(df_trips)
+        scans.append(trips_lf)
 
-    df_trips_all = pl.concat(trips)
+    return pl.concat(scans)
 
-    if is_schedule:
 
-        # account for a bug detailed in github issue #21
-        df_trips_all = df_trips_all.filter(pl.col("bus_stop_time").is_not_null())
+def scan_timetable(rt: str) -> pl.LazyFrame:
+    """
+    lazily scan the clean timetable of a route into the columns of
+    scan_processed_trips. A trip_id is made for each run of a schd_trip_id
+    """
 
-        df_trips_all = df_trips_all.sort(["schd_trip_id", "bus_stop_time"])
+    file = f"{DIR}/clean_timetables/rt{rt}_timetable.parquet"
+    if not os.path.exists(file):
+        raise FileNotFoundError(f"No timetable for route {rt}")
+
+    trips_lf = pl.scan_parquet(file).select(
+        pl.col("route_id").cast(pl.String).cast(pl.Categorical).alias("rt"),
+        pl.col("pid").cast(pl.Float64).cast(pl.Int32),
+        pl.col("stop_id").cast(pl.String).cast(pl.Categorical),
+        pl.col("schd_trip_id").cast(pl.String),
+        pl.col("stop_sequence").cast(pl.Float64).cast(pl.Int32),
+        pl.col("bus_stop_time").cast(pl.Datetime),
+    )
 
-        df_trips_all = df_trips_all.with_columns(
-            total_stops=pl.col("stop_sequence")
-            .cast(pl.Float64)
-            .cast(pl.Int32)
-            .max()
-            .over("schd_trip_id"),
-            trip_rn=pl.col("bus_stop_time").rank("ordinal").over("schd_trip_id"),
-        )
+    # account for a bug detailed in github issue #21
+    trips_lf = trips_lf.filter(pl.col("bus_stop_time").is_not_null())
 
-        # create unique trip id. schd_trip_id is reused so count how many
-        #  stops there are for a schd_trip_id (always the same) and use that
-        # to determine when a trip ends and a new begins for trips with the
-        # same schd_trip_id. tried to use num of stops / seq max for a
-        # pattern but its not a unique value :(
-
-        df_trips_all = df_trips_all.with_columns(
-            pl.struct("schd_trip_id", "total_stops", "trip_rn")
-            .map_elements(
-                lambda x: x["schd_trip_id"]
-                + "-"
-                + str(((x["trip_rn"] - 1) // x["total_stops"])),
-                return_dtype=pl.String,
-            )
-            .alias("trip_id")
+    trips_lf = trips_lf.sort(["schd_trip_id", "bus_stop_time"])
+
+    trips_lf = trips_lf.with_columns(
+        total_stops=pl.col("stop_sequence").max().over("schd_trip_id"),
+        trip_rn=pl.col("bus_stop_time").rank("ordinal").over("schd_trip_id"),
+    )
+
+    # create unique trip id. schd_trip_id is reused so count how many
+    #  stops there are for a schd_trip_id (always the same) and use that
+    # to determine when a trip ends and a new begins for trips with the
+    # same schd_trip_id. tried to use num of stops / seq max for a
+    # pattern but its not a unique value :(
+
+    trips_lf = trips_lf.with_columns(
+        pl.concat_str(
+            "schd_trip_id",
+            ((pl.col("trip_rn") - 1) // pl.col("total_stops")).cast(pl.String),
+            separator="-",
         )
-        df_trips_all = df_trips_all.rename({"route_id": "rt"})
+        .cast(pl.Categorical)
+        .alias("trip_id")
+    )
+
+    return trips_lf.select("rt", "pid", "stop_id", "trip_id", "bus_stop_time")
+
+
+def create_trips_df(
+    rt: str, is_schedule: bool = False, months: list[date] | None = None
+) -> pl.LazyFrame:
+    """
+    Given rts to pids xwalk and a rt, create a lazy df for all the trips of the
+    rt with the columns rt, pid, stop_id, trip_id and bus_stop_time.
+    Only keeps the trips of months if given
+    """
+
+    trips = []
+
+    # just look at the rts for schedule
+    if is_schedule:
+        try:
+            trips.append(scan_timetable(rt))
+        except FileNotFoundError:
+            metrics_logger.debug(f"Do not have timetable for route {rt}. Skipping")
 
     else:
-        df_trips_all = df_trips_all.rename(
-            {
-                "unique_trip_vehicle_day": "trip_id",
-                "stpid": "stop_id",
-            }
+        xwalk = pd.read_parquet(f"{DIR}/rt_to_pid.parquet")
+        pids = xwalk.loc[xwalk["rt"] == rt, "pid"].unique()
+
+        for pid in pids:
+            try:
+                trips.append(scan_processed_trips(pid, months))
+            except FileNotFoundError:
+                metrics_logger.debug(f"Do not have pattern {pid} for route. Skipping")
+
+    df_trips_all = pl.concat(trips)
+
+    # runs of a schd_trip_id need all its months, so filter after
+    if is_schedule and months is not None:
+        df_trips_all = df_trips_all.filter(
+            pl.col("bus_stop_time").dt.truncate("1mo").dt.date().is_in(months)
         )
 
     return df_trips_all
 
 
-def group_metrics(trips_df: pl.DataFrame, metric: str) -> pl.DataFrame:
+def record_changed_partitions(changed: pl.DataFrame) -> None:
+    """
+    add the (rt, month) pairs that got new trips or schedule rows to the ones
+    the next incremental metrics run recomputes
+    """
+
+    changed = changed.select(
+        pl.col("rt").cast(pl.String), pl.col("month").cast(pl.Date)
+    ).drop_nulls()
+
+    if CHANGES_FILE.exists():
+        changed = pl.concat([pl.read_parquet(CHANGES_FILE), changed])
+
+    CHANGES_FILE.parent.mkdir(parents=True, exist_ok=True)
+    changed.unique().sort(["rt", "month"]).write_parquet(CHANGES_FILE)
+
+
+def read_changed_partitions() -> dict[str, list[date]]:
+    """
+    the months that changed for each rt since the last metrics run
+    """
+
+    if not CHANGES_FILE.exists():
+        return {}
+
+    changed = pl.read_parquet(CHANGES_FILE).group_by("rt").agg(pl.col("month").sort())
+
+    return dict(zip(changed["rt"].to_list(), changed["month"].to_list()))
+
+
+def clear_changed_partitions(rts: list[str]) -> None:
+    """
+    remove the rts whose metrics are up to date from the changed partitions
+    """
+
+    if not CHANGES_FILE.exists():
+        return
+
+    changed = pl.read_parquet(CHANGES_FILE).filter(~pl.col("rt").is_in(rts))
+
+    if changed.is_empty():
+        CHANGES_FILE.unlink()
+    else:
+        changed.write_parquet(CHANGES_FILE)
+
+
+def metric_stats(metric: str) -> list[pl.Expr]:
     """
-    Given a metric and a trips dataframe, this function will group the data by hour, day, week, month and year.
+    count, median, q25 and q75 of a metric
     """
 
-    if "trip_duration" in metric:
+    return [
+        pl.count(metric).alias(f"count_{metric}"),
+        pl.median(metric).alias(f"median_{metric}"),
+        pl.col(metric).quantile(0.25).alias(f"q25_{metric}"),
+        pl.col(metric).quantile(0.75).alias(f"q75_{metric}"),
+    ]
+
+
+def group_metrics(
+    trips_df: pl.DataFrame,
+    metrics: str | list[str],
+    periods: list[str] | None = None,
+    sketch_accuracy: float | None = None,
+) -> pl.DataFrame:
+    """
+    Given metrics and a trips dataframe, this function will group the data by hour, day, week, month and year.
+    Only the periods in periods are grouped if given. With sketch_accuracy the
+    data is grouped into quantile sketches per month instead, see sketch_quantiles
+
+    All the metrics of a period are aggregated together and all the periods
+    are built as one lazy query, so the trips are scanned once and collected
+    once. Bus counts are counted by the time unit of the period (hour, day,
+    month or year) first.
+    """
+
+    if isinstance(metrics, str):
+        metrics = [metrics]
+
+    if any("trip_duration" in metric for metric in metrics):
         groupings = ["rt", "pid"]
+        time_col = "start_trip"
     else:
         groupings = ["rt", "pid", "stop_id"]
+        time_col = "bus_stop_time"
 
-    all_periods = []
+    value_metrics = [metric for metric in metrics if "num_buses" not in metric]
+    bus_metrics = [metric for metric in metrics if "num_buses" in metric]
 
     last_month = (date.today().replace(day=1) - timedelta(days=1)).replace(day=1)
 
-    for name, grouping, trunc in [
-        ("hour", "hour", "1h"),
-        ("weekday", "weekday", "1d"),
-        ("month", "month", "1mo"),
-        ("year", "year", "1y"),
-        # ("week_abs", "1w"),
-        ("month_abs", "month_abs", "1mo"),
-        # adding more groupings
-        ("year_hour", ["year", "hour"], "1h"),  # year hour
-        ("year_weekday", ["year", "weekday"], "1d"),  # year weekday
-        ("last_full_month", "last_full_month", "something"),  # last month
-    ]:
-
-        group_list = groupings.copy()
-
-        if isinstance(grouping, list):
-            group_list = group_list + grouping
-        else:
-            group_list.append(grouping)
-
-        if "num_buses" in metric:
-            if isinstance(grouping, list):
-                trunc_name = grouping[1]
-            else:
-                trunc_name = grouping
-
-            if grouping == "last_full_month":
-                df = trips_df.filter(
-                    pl.col("bus_stop_time").dt.year() == last_month.year
-                ).filter(pl.col("bus_stop_time").dt.month() == last_month.month)
-
-                df = df.with_columns(pl.lit(grouping).alias(grouping))
-            else:
-                df = trips_df.with_columns(
-                    pl.col("bus_stop_time").dt.truncate(trunc).alias(trunc_name)
-                )
+    time = pl.col(time_col)
+    bus_time = pl.col("bus_stop_time")
+
+    # period: (period value, time unit to count buses by)
+    period_keys = {
+        "hour": (time.dt.hour(), bus_time.dt.truncate("1h")),
+        "weekday": (time.dt.weekday(), bus_time.dt.truncate("1d")),
+        "month": (time.dt.month(), bus_time.dt.truncate("1mo")),
+        "year": (time.dt.year(), bus_time.dt.truncate("1y")),
+        "month_abs": (time.dt.truncate("1mo"), bus_time.dt.truncate("1mo")),
+        "year_hour": (
+            pl.concat_str([time.dt.year(), time.dt.hour()], separator="-"),
+            bus_time.dt.truncate("1h"),
+        ),
+        "year_weekday": (
+            pl.concat_str([time.dt.year(), time.dt.weekday()], separator="-"),
+            bus_time.dt.truncate("1d"),
+        ),
+        "last_full_month": (pl.lit("last_full_month"), bus_time.dt.truncate("1mo")),
+    }
+
+    # sketches are kept per month of data
+    if sketch_accuracy is None:
+        month_cols, month_keys = [], []
+    else:
+        month_cols, month_keys = [sketch_month(time_col)], ["data_month"]
+    keys = [*groupings, "period_value", *month_keys]
+
+    trips_lf = trips_df.lazy()
+    all_periods = []
+
+    for name, (period_value, bus_unit) in period_keys.items():
+        if periods is not None and name not in periods:
+            continue
+
+        # sketch_quantiles makes last_full_month from month_abs
+        if sketch_accuracy is not None and name == "last_full_month":
+            continue
 
-            df = df.group_by([*group_list]).agg(
-                pl.col("bus_stop_time").count().alias(metric)
+        period_lf = trips_lf
+        if name == "last_full_month":
+            period_lf = period_lf.filter(
+                (bus_time.dt.year() == last_month.year)
+                & (bus_time.dt.month() == last_month.month)
             )
 
-            # this becomes the period_value
-            if grouping == "hour":
-                df = df.with_columns((pl.col(trunc_name).dt.hour()).alias(name))
-            elif grouping == "weekday":
-                df = df.with_columns((pl.col(trunc_name).dt.weekday()).alias(name))
-            elif grouping == "month":
-                df = df.with_columns((pl.col(trunc_name).dt.month()).alias(name))
-            elif grouping == "year":
-                df = df.with_columns((pl.col(trunc_name).dt.year()).alias(name))
-            elif grouping == ["year", "hour"]:
-                df = df.with_columns(
-                    pl.concat_str(
-                        [pl.col(trunc_name).dt.year(), pl.col(trunc_name).dt.hour()],
-                        separator="-",
-                    ).alias(name),
-                )
-            elif grouping == ["year", "weekday"]:
-                df = df.with_columns(
-                    pl.concat_str(
-                        [pl.col(trunc_name).dt.year(), pl.col(trunc_name).dt.weekday()],
-                        separator="-",
-                    ).alias(name),
-                )
-            elif grouping == "last_full_month":
-                # already added this so can
-                pass
+        period_lf = period_lf.select(
+            *groupings,
+            period_value.alias("period_value"),
+            bus_unit.alias("bus_unit"),
+            *month_cols,
+            *value_metrics,
+        )
 
-        else:
-            if "trip_duration" in metric:
-                time_col = "start_trip"
-            else:
-                time_col = "bus_stop_time"
-
-            # this becomes the period_value
-            if grouping == "hour":
-                df = trips_df.with_columns((pl.col(time_col).dt.hour()).alias(name))
-            elif grouping == "weekday":
-                df = trips_df.with_columns((pl.col(time_col).dt.weekday()).alias(name))
-            elif grouping == "month":
-                df = trips_df.with_columns((pl.col(time_col).dt.month()).alias(name))
-            elif grouping == "year":
-                df = trips_df.with_columns((pl.col(time_col).dt.year()).alias(name))
-            elif grouping == "month_abs":
-                df = trips_df.with_columns(
-                    pl.col(time_col).dt.truncate(trunc).alias("month_abs")
-                )
-            elif grouping == "week_abs":
-                df = trips_df.with_columns(
-                    pl.col(time_col).dt.truncate(trunc).alias("week_abs")
-                )
-            elif grouping == ["year", "hour"]:
-                df = trips_df.with_columns(
-                    pl.concat_str(
-                        [pl.col(time_col).dt.year(), pl.col(time_col).dt.hour()],
-                        separator="-",
-                    ).alias(name),
+        # buses at each stop in each time unit of the period
+        bus_counts = {
+            metric: period_lf.group_by([*keys, "bus_unit"]).agg(
+                pl.col("bus_unit").count().alias(metric)
+            )
+            for metric in bus_metrics
+        }
+
+        if sketch_accuracy is None:
+            grouped = []
+            if value_metrics:
+                stats = [s for metric in value_metrics for s in metric_stats(metric)]
+                grouped.append(period_lf.group_by(keys).agg(stats))
+            for metric, counts_lf in bus_counts.items():
+                grouped.append(counts_lf.group_by(keys).agg(metric_stats(metric)))
+
+            grouped_lf = grouped[0]
+            for other_lf in grouped[1:]:
+                grouped_lf = grouped_lf.join(
+                    other_lf, on=keys, how="full", coalesce=True
                 )
-            elif grouping == ["year", "weekday"]:
-                df = trips_df.with_columns(
-                    pl.concat_str(
-                        [pl.col(time_col).dt.year(), pl.col(time_col).dt.weekday()],
-                        separator="-",
-                    ).alias(name),
+        else:
+            # bucket counts per month of data, a year of buses is not the sum
+            # of monthly sketches so sketch_quantiles makes it from month_abs
+            values = []
+            if value_metrics:
+                values.append(
+                    period_lf.unpivot(
+                        index=keys,
+                        on=value_metrics,
+                        variable_name="metric",
+                        value_name="value",
+                    ).with_columns(pl.col("value").cast(pl.Float64))
                 )
-            elif grouping == "last_full_month":
-                df = trips_df.filter(
-                    pl.col("bus_stop_time").dt.year() == last_month.year
-                ).filter(pl.col("bus_stop_time").dt.month() == last_month.month)
+            if name != "year":
+                for metric, counts_lf in bus_counts.items():
+                    values.append(
+                        counts_lf.select(
+                            *keys,
+                            pl.lit(metric).alias("metric"),
+                            pl.col(metric).cast(pl.Float64).alias("value"),
+                        )
+                    )
+
+            grouped_lf = (
+                pl.concat(values)
+                .with_columns(sketch_bucket("value", sketch_accuracy))
+                .group_by([*keys, "metric", "bucket"])
+                .agg(pl.count("value").alias("count"))
+            )
+
+        # retype ids and period value as string once they are aggregated
+        all_periods.append(
+            grouped_lf.with_columns(
+                pl.col(*groupings, "period_value").cast(pl.String),
+                pl.lit(name).alias("period"),
+            )
+        )
+
+    # all the periods are collected in one query
+    all_periods_lf = pl.concat(all_periods)
+
+    if sketch_accuracy is not None:
+        return (
+            all_periods_lf.sort(pl.col("metric").cast(pl.Enum(metrics)))
+            .select(*keys, "bucket", "count", "period", "metric")
+            .collect()
+        )
+
+    # same column order as joining the metrics one by one
+    columns = [*groupings, "period_value"]
+    for i, metric in enumerate(metrics):
+        columns += [f"{stat}_{metric}" for stat in ["count", "median", "q25", "q75"]]
+        if i == 0:
+            columns.append("period")
+
+    return all_periods_lf.select(columns).collect()
+
+
+def sketch_month(time_col: str) -> pl.Expr:
+    """
+    month of the data a sketch row comes from
+    """
+
+    return pl.col(time_col).dt.truncate("1mo").dt.date().alias("data_month")
+
+
+def sketch_bucket(metric: str, accuracy: float) -> pl.Expr:
+    """
+    bucket of each value of metric in a sketch with logarithmic buckets (as in
+    DDSketch). Every value in a bucket is within accuracy (relative) of the
+    value of the bucket, so sketches are merged by adding up the counts
+    """
+
+    gamma = (1 + accuracy) / (1 - accuracy)
+    value = pl.col(metric).cast(pl.Float64)
+    magnitude = pl.when(value != 0).then(value.abs())
+    index = (magnitude.log() / math.log(gamma)).ceil().cast(pl.Int64)
+
+    return (
+        pl.when(value > 0)
+        .then(index + SKETCH_OFFSET)
+        .when(value < 0)
+        .then(-(index + SKETCH_OFFSET))
+        .when(value == 0)
+        .then(0)
+        .alias("bucket")
+    )
 
-                df = df.with_columns(pl.lit(grouping).alias(grouping))
 
-        final_group = groupings.copy()
-        final_group.append(name)
+def bucket_value(accuracy: float) -> pl.Expr:
+    """
+    the value a sketch bucket stands for, the inverse of sketch_bucket
+    """
+
+    gamma = (1 + accuracy) / (1 - accuracy)
+    index = pl.col("bucket").abs() - SKETCH_OFFSET
+    value = pl.lit(gamma).pow(index) * 2 / (gamma + 1)
+
+    return (
+        pl.when(pl.col("bucket") == 0)
+        .then(0.0)
+        .otherwise(value * pl.col("bucket").sign())
+    )
+
+
+def sketch_quantiles(
+    sketch_df: pl.DataFrame, metric: str, accuracy: float
+) -> pl.DataFrame:
+    """
+    Merge the monthly sketches of a metric and take the count, median, q25 and
+    q75 for each period. Returns the same columns as group_metrics, the
+    quantiles are within accuracy of the exact ones
+
+    Arguments:
+        - sketch_df: group_metrics output made with sketch_accuracy=accuracy
+        for any number of months
+        - metric: the metric of the sketches
+        - accuracy: relative accuracy the sketches were made with
+    """
 
-        grouped_df = df.group_by([*final_group]).agg(
-            pl.count(metric).alias(f"count_{metric}"),
-            pl.median(metric).alias(f"median_{metric}"),
-            pl.col(metric).quantile(0.25).alias(f"q25_{metric}"),
-            pl.col(metric).quantile(0.75).alias(f"q75_{metric}"),
+    groupings = [
+        col
+        for col in sketch_df.columns
+        if col not in ["period_value", "data_month", "bucket", "count", "period"]
+    ]
+    keys = [*groupings, "period", "period_value"]
+
+    last_month = (date.today().replace(day=1) - timedelta(days=1)).replace(day=1)
+    month_abs = sketch_df.filter(pl.col("period") == "month_abs")
+
+    derived = [
+        month_abs.filter(pl.col("data_month") == last_month).with_columns(
+            period=pl.lit("last_full_month"), period_value=pl.lit("last_full_month")
+        )
+    ]
+
+    if "num_buses" in metric:
+        # buses in a year, adding up the buses of each month
+        derived.append(
+            month_abs.group_by([*groupings, pl.col("data_month").dt.year()])
+            .agg((bucket_value(accuracy) * pl.col("count")).sum().alias(metric))
+            .with_columns(
+                sketch_bucket(metric, accuracy),
+                pl.lit(1, dtype=pl.UInt32).alias("count"),
+                period=pl.lit("year"),
+                period_value=pl.col("data_month").cast(pl.String),
+                data_month=pl.date(pl.col("data_month"), 1, 1),
+            )
+            .select(sketch_df.columns)
         )
 
-        grouped_df = grouped_df.with_columns((pl.lit(name).alias("period")))
+    merged = (
+        pl.concat([sketch_df, *[df.select(sketch_df.columns) for df in derived]])
+        .group_by([*keys, "bucket"])
+        .agg(pl.col("count").sum())
+        .sort("bucket", nulls_last=False)
+        .with_columns(
+            value=bucket_value(accuracy),
+            rank=pl.col("count").cum_sum().over(keys),
+            total=pl.col("count").sum().over(keys),
+        )
+    )
+
+    # the value at a rank (0 based) in the sorted values of the period
+    def value_at(rank: pl.Expr) -> pl.Expr:
+        return pl.col("value").filter(pl.col("rank") > rank).first()
+
+    # same interpolation as the exact median and quantiles
+    position = pl.col("total").first() - 1
+    lower = value_at((position * 0.5).floor())
+    upper = value_at((position * 0.5).ceil())
 
-        grouped_df = grouped_df.rename({name: "period_value"})
+    grouped_df = merged.group_by(keys).agg(
+        pl.col("count").sum().alias(f"count_{metric}"),
+        ((lower + upper) / 2).alias(f"median_{metric}"),
+        value_at((position * 0.25 + 0.5).floor()).alias(f"q25_{metric}"),
+        value_at((position * 0.75 + 0.5).floor()).alias(f"q75_{metric}"),
+    )
+
+    return grouped_df.select(
+        *groupings,
+        "period_value",
+        f"count_{metric}",
+        f"median_{metric}",
+        f"q25_{metric}",
+        f"q75_{metric}",
+        "period",
+    )
+
+
+def recalculated_months(months: list[date]) -> list[date]:
+    """
+    the changed months and the month before each of them, whose last buses
+    wait for buses in the changed month
+    """
 
-        # retype period value as string
-        grouped_df = grouped_df.with_columns(pl.col("period_value").cast(pl.String))
+    previous = [(month - timedelta(days=1)).replace(day=1) for month in months]
 
-        all_periods.append(grouped_df)
+    return sorted(set(months) | set(previous))
 
-        all_periods_df = pl.concat(all_periods)
 
-    return all_periods_df
+def group_metrics_months(
+    trips_df: pl.DataFrame, metrics: str | list[str], months: list[date]
+) -> pl.DataFrame:
+    """
+    group_metrics for only the period values that include one of months. The
+    periods over all years (hour, weekday, month) still use all the trips,
+    year and month periods only use the trips of the changed years and months,
+    and of the month before each changed month (see recalculated_months).
+    trips_df has the trips of the months after them too, so the time till
+    the next bus at the end of a month is filled
+    """
+
+    if isinstance(metrics, str):
+        metrics = [metrics]
+
+    if any("trip_duration" in metric for metric in metrics):
+        time_col = "start_trip"
+    else:
+        time_col = "bus_stop_time"
+
+    last_month = (date.today().replace(day=1) - timedelta(days=1)).replace(day=1)
+    months = recalculated_months(months)
+    years = sorted({month.year for month in months})
+    month_starts = sorted(set(months) | {last_month})
+
+    in_years = trips_df.filter(pl.col(time_col).dt.year().is_in(years))
+    in_months = trips_df.filter(
+        pl.col(time_col).dt.truncate("1mo").dt.date().is_in(month_starts)
+    )
+
+    return pl.concat(
+        [
+            group_metrics(trips_df, metrics, ALL_TIME_PERIODS),
+            group_metrics(in_years, metrics, YEAR_PERIODS),
+            group_metrics(in_months, metrics, MONTH_PERIODS),
+        ]
+    )
 
 
 def create_trips_df_pid(
@@ -267,11 +598,10 @@ def create_trips_df_pid(
     """
     # just look at the rts for schedule
 
-    file_DIR = f"{DIR}/processed_by_pid/trips_{pid}_full.parquet"
     error = f"Do not have pattern {pid} for route. Skipping"
 
     try:
-        df_trips = pl.read_parquet(file_DIR)
+        df_trips = read_processed_trips(pid)
     except FileNotFoundError:
         print(error)
 
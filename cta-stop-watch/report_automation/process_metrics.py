@@ -1,31 +1,55 @@
-from utils import metrics_logger, clear_staging
+from utils import metrics_logger, clear_staging, sample_peak_rss
+from telemetry import span
 from store_data import store_all_data
-from update_metrics import update_metrics, combine_recent_trips
+from update_metrics import MEMORY_LIMIT, update_metrics, combine_recent_trips
 from update_schedule import update_schedule
 
 # Functions -------------------------------------------------------------------
 
 
-def process_metrics(local: bool = True) -> None:
+def process_metrics(
+    local: bool = True,
+    incremental: bool = False,
+    sketch_accuracy: float | None = None,
+    workers: int | None = None,
+    memory_limit: str = MEMORY_LIMIT,
+    sample_memory: bool = False,
+) -> None:
     """
-    Implement workflow to process metrics data
+    Implement workflow to process metrics data. With incremental only the
+    routes and months with new trips or schedule rows are recalculated, with
+    sketch_accuracy quantiles come from sketches, routes are calculated in
+    workers processes and combined within memory_limit (see update_metrics).
+    With sample_memory the peak memory of updating the metrics is logged
     """
 
     # combine recent trips
     metrics_logger.info("Combining trips")
-    combine_recent_trips()
+    with span("combine_recent_trips"):
+        combine_recent_trips()
     metrics_logger.info("Done combining trips")
     clear_staging(folders=["staging/trips"])
 
     # update schedule
     metrics_logger.info("Updating schedule")
-    update_schedule()
+    with span("update_schedule"):
+        update_schedule()
     metrics_logger.info("Done updating schedule")
     clear_staging(folders=["staging/timetables/current_timetables"])
 
     # update metrics
     metrics_logger.info("Updating metrics")
-    update_metrics("all")
+    with (
+        span("update_metrics"),
+        sample_peak_rss("Updating metrics", metrics_logger, enabled=sample_memory),
+    ):
+        update_metrics(
+            "all",
+            incremental=incremental,
+            sketch_accuracy=sketch_accuracy,
+            workers=workers,
+            memory_limit=memory_limit,
+        )
     metrics_logger.info("Done updating metrics")
 
     # push all date to s3
@@ -1,9 +1,13 @@
 import pandas as pd
+import numpy as np
 import geopandas as gpd
-from shapely import LineString
+import shapely
 import pathlib
+import hashlib
+import json
+import os
 from utils import process_logger
-from pyproj import CRS
+from pyproj import CRS, Transformer
 
 # Constants -------------------------------------------------------------------
 
@@ -17,10 +21,69 @@ PID_DIR = pathlib.Path(__file__).parent / "data/patterns"
 # Projections
 PROJ_4326 = CRS("epsg:4326")
 PROJ_26971 = CRS("epsg:26971")
+TO_26971 = Transformer.from_crs(PROJ_4326, PROJ_26971, always_xy=True)
 
 # Functions -------------------------------------------------------------------
 
 
+def file_hash(path: str) -> str | None:
+    """
+    sha1 of a file, None if there is no file
+    """
+
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+def pattern_key(pid: str) -> str | None:
+    """
+    sha1 of the raw pattern file with the buffer and projection its
+    geometries are built with, None if there is no raw pattern
+    """
+
+    digest = file_hash(f"{PID_DIR}/patterns_raw/pid_{pid}_raw.parquet")
+    if digest is None:
+        return None
+
+    return f"{digest}-{BUFFER_DIST}-{PROJ_26971.to_epsg()}"
+
+
+def read_manifest() -> dict[str, str]:
+    """
+    the pattern_key of the raw pattern each processed pattern was built from
+    """
+
+    if not os.path.exists(f"{PID_DIR}/patterns_manifest.json"):
+        return {}
+
+    with open(f"{PID_DIR}/patterns_manifest.json", "r") as file:
+        return json.load(file)
+
+
+def write_manifest(manifest: dict[str, str]) -> None:
+    with open(f"{PID_DIR}/patterns_manifest.json.tmp", "w") as file:
+        json.dump(manifest, file, indent=0, sort_keys=True)
+    os.replace(
+        f"{PID_DIR}/patterns_manifest.json.tmp", f"{PID_DIR}/patterns_manifest.json"
+    )
+
+
+def clear_pattern_cache(pids: list[str]) -> None:
+    """
+    remove the cached stop time bundles of patterns, see
+    calculate_stop_time.pattern_bundle
+    """
+
+    for pid in pids:
+        for type in ["segments", "stops"]:
+            path = f"{PID_DIR}/patterns_cache/pid_{pid}_{type}.parquet"
+            if os.path.exists(path):
+                os.remove(path)
+
+
 def load_raw_pattern(pid: str) -> tuple[bool, pd.DataFrame] | tuple[bool, bool]:
     try:
         df_raw = pd.read_parquet(f"{PID_DIR}/patterns_raw/pid_{pid}_raw.parquet")
@@ -29,6 +92,96 @@ def load_raw_pattern(pid: str) -> tuple[bool, pd.DataFrame] | tuple[bool, bool]:
         return False, False
 
 
+def segment_geometries(x: np.ndarray, y: np.ndarray, first: np.ndarray) -> np.ndarray:
+    """
+    geometries of the segments of stacked patterns: a point for the first
+    point of each pattern (where first is True) and a line from the point
+    before for every other point
+    """
+
+    geometries = shapely.points(x, y)
+
+    # each point with the one before, as (point before, point) pairs
+    pairs = np.stack(
+        [np.column_stack([x[:-1], y[:-1]]), np.column_stack([x[1:], y[1:]])], axis=1
+    )
+    lines = ~first[1:]
+    geometries[1:][lines] = shapely.linestrings(pairs[lines])
+
+    return geometries
+
+
+def build_geometries(
+    raw_patterns: dict[str, pd.DataFrame],
+) -> dict[str, tuple[gpd.GeoDataFrame, gpd.GeoDataFrame]]:
+    """
+    build the stops and segments of many patterns at once. The points of all
+    the patterns are projected, turned into segments and buffered together,
+    then split back by pid.
+
+    Input:
+        - raw_patterns (dict): raw pattern df of each pid
+
+    Returns:
+        - dict of pid to the stops (points) and segments (buffers) of the
+        pattern, as written by convert_to_geometries
+    """
+
+    if not raw_patterns:
+        return {}
+
+    pids = list(raw_patterns)
+    sorted_raw = [raw_patterns[pid].sort_values(by="seq") for pid in pids]
+    sizes = np.array([len(df_raw) for df_raw in sorted_raw], dtype=int)
+    starts = np.cumsum(sizes) - sizes
+
+    lon = np.concatenate([df_raw["lon"].to_numpy(float) for df_raw in sorted_raw])
+    lat = np.concatenate([df_raw["lat"].to_numpy(float) for df_raw in sorted_raw])
+    first = np.zeros(len(lon), dtype=bool)
+    first[starts[sizes > 0]] = True
+
+    # Each pair of points consitutes a segment, in feet in the projection for Chicago
+    x, y = TO_26971.transform(lon, lat)
+    projected = gpd.GeoSeries(segment_geometries(x, y, first), crs=PROJ_26971)
+    length_ft = projected.length.to_numpy() * M_TO_FT
+    buffers = projected.buffer(BUFFER_DIST).to_crs(PROJ_4326).to_numpy()
+    lines = segment_geometries(lon, lat, first)
+
+    geometries = {}
+    for pid, df_raw, start, size in zip(pids, sorted_raw, starts, sizes):
+        rows = slice(start, start + size)
+
+        df_pattern = gpd.GeoDataFrame(
+            df_raw,
+            geometry=gpd.GeoSeries.from_xy(
+                x=lon[rows], y=lat[rows], index=df_raw.index, crs=PROJ_4326
+            ),
+        )
+        df_pattern.loc[:, "segment"] = range(0, size)
+        # create unique id for each stop on the pattern
+        df_pattern["p_stp_id"] = str(pid) + "-" + df_pattern["stpid"]
+
+        df_segment = gpd.GeoDataFrame(
+            data={"segments": range(0, size)}, geometry=buffers[rows], crs=PROJ_4326
+        )
+        df_segment.loc[:, "length_ft"] = length_ft[rows]
+        df_segment.loc[:, "ls_geometry"] = gpd.GeoSeries(lines[rows], crs=PROJ_4326)
+
+        geometries[pid] = (df_pattern, df_segment)
+
+    return geometries
+
+
+def write_geometries(
+    pid: str, df_pattern: gpd.GeoDataFrame, df_segment: gpd.GeoDataFrame
+) -> None:
+    process_logger.debug(
+        f"Writing patterns_current/pid_{pid}_stop.parquet and patterns_current/pid_{pid}_segment.parquet"
+    )
+    df_pattern.to_parquet(f"{PID_DIR}/patterns_current/pid_{pid}_stop.parquet")
+    df_segment.to_parquet(f"{PID_DIR}/patterns_current/pid_{pid}_segment.parquet")
+
+
 def convert_to_geometries(
     df_raw: pd.DataFrame, pid: str, write: bool = True
 ) -> bool | gpd.GeoDataFrame:
@@ -52,78 +205,70 @@ def convert_to_geometries(
 
     """
 
-    # Convert into geodata with projection for Chicago (EPSG 4326)
-    df_pattern = gpd.GeoDataFrame(
-        df_raw,
-        geometry=gpd.GeoSeries.from_xy(
-            x=df_raw.loc[:, "lon"], y=df_raw.loc[:, "lat"], crs=PROJ_4326
-        ),
-    )
-
-    df_pattern = df_pattern.sort_values(by="seq")
-
-    # Each pair of points consitutes a segment, assign id for future grouping
-    df_pattern.loc[:, "segment"] = range(0, len(df_pattern))
-
-    # Build line geometries with each segment (pair of points)
-    segments = list(range(0, len(df_pattern)))
-    geometries = []
-
-    for segment_id, segment_data in df_pattern.iterrows():
-        # The first bus stop is stored as a point geometry instead of line
-        if segment_id == 0.0:
-            geometries.append(segment_data["geometry"])
-            continue
-        previous_point = df_pattern.iloc[segment_id - 1]["geometry"]
-        geometry = LineString([previous_point, segment_data["geometry"]])
-        geometries.append(geometry)
-
-    # Change projection and units so distance and time can be computed (in feet)
-    df_segment = gpd.GeoDataFrame(
-        data={"segments": segments}, geometry=geometries, crs=PROJ_4326
-    ).sort_values("segments")
-    df_segment.loc[:, "length_ft"] = (
-        df_segment.geometry.to_crs(PROJ_26971).length * M_TO_FT
-    )
-    df_segment.loc[:, "ls_geometry"] = df_segment.geometry
-    df_segment.geometry = (
-        df_segment.geometry.to_crs(PROJ_26971).buffer(BUFFER_DIST).to_crs(PROJ_4326)
-    )
-
-    # create unique id for each stop on the pattern
-    df_pattern["p_stp_id"] = str(pid) + "-" + df_pattern["stpid"]
+    df_pattern, df_segment = build_geometries({pid: df_raw})[pid]
 
     if write:
-        process_logger.debug(
-            f"Writing patterns_current/pid_{pid}_stop.parquet and patterns_current/pid_{pid}_segment.parquet"
-        )
-        df_pattern.to_parquet(f"{PID_DIR}/patterns_current/pid_{pid}_stop.parquet")
-        df_segment.to_parquet(f"{PID_DIR}/patterns_current/pid_{pid}_segment.parquet")
-
+        write_geometries(pid, df_pattern, df_segment)
         return True
     return df_segment
 
 
-def process_patterns(pids: list[str]):
+def convert_patterns(raw_patterns: dict[str, pd.DataFrame]) -> None:
+    """
+    convert and write many patterns in one call, see build_geometries
+    """
+
+    for pid, (df_pattern, df_segment) in build_geometries(raw_patterns).items():
+        write_geometries(pid, df_pattern, df_segment)
+        process_logger.debug(f"Success in converting pattern {pid} to geometry")
+
+
+def process_patterns(pids: list[str], force: bool = False) -> int:
     """
-    process all the patterns
+    process all the patterns. Patterns whose raw pattern, buffer and
+    projection are the same as when they were last built are skipped, unless
+    force is True. Returns the number of patterns built
     """
     bad_pids = []
+    raw_patterns = {}
+    manifest = read_manifest()
+    keys = {}
     for pid in pids:
 
+        keys[pid] = pattern_key(pid)
+        if keys[pid] is None:
+            bad_pids.append(pid)
+            continue
+
+        built = os.path.exists(
+            f"{PID_DIR}/patterns_current/pid_{pid}_stop.parquet"
+        ) and os.path.exists(f"{PID_DIR}/patterns_current/pid_{pid}_segment.parquet")
+        if not force and built and manifest.get(pid) == keys[pid]:
+            continue
+
         found, df_raw = load_raw_pattern(pid)
         if not found:
             bad_pids.append(pid)
             continue
-        else:
-            convert_to_geometries(df_raw, pid)
-            process_logger.debug(f"Success in converting pattern {pid} to geometry")
+        raw_patterns[pid] = df_raw
+
+    process_logger.info(
+        f"Building {len(raw_patterns)} changed or new pattern(s), "
+        f"{len(pids) - len(raw_patterns) - len(bad_pids)} did not change"
+    )
+    convert_patterns(raw_patterns)
+    clear_pattern_cache(list(raw_patterns))
+
+    manifest.update({pid: keys[pid] for pid in raw_patterns})
+    write_manifest(manifest)
 
     if len(bad_pids) > 0:
         process_logger.info(
             f"Missing {len(bad_pids)} PIDs from ghost bus data that we do not have. List here: {bad_pids}"
         )
 
+    return len(raw_patterns)
+
 
 # Implementation --------------------------------------------------------------
 
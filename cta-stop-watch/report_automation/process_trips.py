@@ -1,19 +1,21 @@
-from download import full_download, extract_routes, query_cta_api
+from download import full_download, extract_routes, fetch_patterns
 from process_patterns import process_patterns
 from calculate_stop_time import calculate_patterns
 from utils import create_config, clear_staging, process_logger, create_rt_pid_xwalk
+from telemetry import span
 
 from datetime import date, timedelta, datetime
-import polars as pl
 import pandas as pd
 import duckdb
 import json
+import glob
 import os
 
 # Constants -------------------------------------------------------------------
 
 # Paths
 STAGING_PATH = "data/staging"
+DAY_PATH = "data/processed_by_day"
 
 # Functions -------------------------------------------------------------------
 
@@ -35,9 +37,11 @@ def update_data(start_date: str, today: str) -> bool:
     return True
 
 
-def update_patterns(EXISTING_PATTERNS: list) -> set[str]:
+def update_patterns(EXISTING_PATTERNS: list, force: bool = False) -> tuple[int, int]:
     """
     check for new patterns in the data and download them from CTA API if doesnt exist.
+    Only new or changed patterns are processed, unless force is True. Returns
+    the number of patterns checked and the number built
     """
     # get all patterns in the database from new data
     new_trip_pids = pd.read_parquet(f"{STAGING_PATH}/all_pids_list.parquet")
@@ -52,19 +56,14 @@ def update_patterns(EXISTING_PATTERNS: list) -> set[str]:
     found_pids = []
     if len(new_patterns) > 0:
         # for any new patterns, try to download from the api
-
-        for pid in new_patterns:
-            try:
-                query_cta_api(pid, "data/patterns/patterns_raw")
-                found_pids.append(pid)
-            except Exception as e:
-                print(f"Error downloading pattern {pid}: {e}")
-                bad_pids.append(pid)
+        found_pids, bad_pids = fetch_patterns(
+            new_patterns, "data/patterns/patterns_raw"
+        )
 
     # process all patterns
     all_patterns = set(found_pids + EXISTING_PATTERNS)
     process_logger.info(f"Processing {len(all_patterns)} patterns")
-    process_patterns(list(all_patterns))
+    built = process_patterns(list(all_patterns), force=force)
 
     process_logger.info(
         f""" Found {len(new_patterns)} new pattern(s) in data \n
@@ -73,61 +72,74 @@ def update_patterns(EXISTING_PATTERNS: list) -> set[str]:
         """
     )
 
-    return new_trip_pids
+    return len(all_patterns), built
 
 
-def trip_to_day() -> None:
+def count_rows(path: str) -> int:
     """
-    convert the current trip data into day data
+    rows of the parquet files matching path, 0 if there are none
     """
 
-    # combine all the pattern trip files into one
-
-    all_data = """COPY
-    (SELECT
-        *
-    FROM read_parquet('data/staging/trips/*.parquet'))
-    TO 'data/staging/trips/combined.parquet'
-    (FORMAT 'parquet');"""
+    if not glob.glob(path):
+        return 0
 
-    duckdb.execute(all_data)
+    return duckdb.execute(f"SELECT count(*) FROM read_parquet('{path}')").fetchone()[0]
 
-    dates = """SELECT
-        strftime(bus_stop_time, '%Y-%m-%d') as day,
-    FROM read_parquet('data/staging/trips/*.parquet')
-    group by 1"""
-
-    dates_df = duckdb.execute(dates).df()
-
-    all_trips = pl.scan_parquet("data/staging/trips/combined.parquet")
-
-    date_fmt = "%F"
-
-    for day in dates_df["day"].tolist():
-        by_day = all_trips.filter(
-            pl.col("bus_stop_time").dt.date()
-            == pl.lit(day).str.strptime(pl.Date, format=date_fmt)
-        )
-        if os.path.exists(f"data/processed_by_day/{day}.parquet"):
 
-            # combine files
-            # TODO make sure this is working properly
-            combine = f"""COPY
-                        (SELECT  *
-                        FROM     read_parquet('data/processed_by_day/{day}.parquet')
-                        UNION ALL
-                        SELECT  *
-                        from    by_day
-                        ) TO 'data/processed_by_day/{day}.parquet'
-                        (FORMAT 'parquet');"""
-
-            duckdb.execute(combine)
-
-        else:
-            by_day.sink_parquet(f"data/processed_by_day/{day}.parquet")
+def trip_to_day() -> None:
+    """
+    convert the current trip data into day data
 
+    All the staged trips are appended in one write partitioned by day, as
+    processed_by_day/day=YYYY-MM-DD/part-<uuid>.parquet. Stop times already
+    written for a day (by trip, stop and stop sequence) are not added again.
+    """
 
-def process_new_trips(test: bool = False) -> None:
+    staged = f"read_parquet('{STAGING_PATH}/trips/*/*.parquet', union_by_name = true)"
+
+    days_command = f"""SELECT DISTINCT strftime(bus_stop_time, '%Y-%m-%d') AS day
+    FROM {staged}"""
+    days = duckdb.execute(days_command).df()["day"].dropna().tolist()
+
+    # stop times already written for the staged days, old {{day}}.parquet too
+    existing = []
+    for day in days:
+        existing += glob.glob(f"{DAY_PATH}/day={day}/*.parquet")
+        if os.path.exists(f"{DAY_PATH}/{day}.parquet"):
+            existing.append(f"{DAY_PATH}/{day}.parquet")
+
+    if existing:
+        file_list = ", ".join(f"'{f}'" for f in existing)
+        written = f"""AND NOT EXISTS (
+            SELECT 1
+            FROM read_parquet([{file_list}],
+                              union_by_name = true, hive_partitioning = false) w
+            WHERE w.unique_trip_vehicle_day = s.unique_trip_vehicle_day
+              AND w.p_stp_id = s.p_stp_id
+              AND w.stop_sequence = s.stop_sequence)"""
+    else:
+        written = ""
+
+    command = f"""COPY
+    (SELECT *, strftime(bus_stop_time, '%Y-%m-%d') AS day
+    FROM {staged} s
+    WHERE bus_stop_time IS NOT NULL
+    {written}
+    QUALIFY row_number() OVER (
+        PARTITION BY unique_trip_vehicle_day, p_stp_id, stop_sequence
+    ) = 1)
+    TO '{DAY_PATH}'
+    (FORMAT 'parquet', PARTITION_BY (day), APPEND true,
+    FILENAME_PATTERN 'part-{{uuid}}');"""
+
+    duckdb.execute(command)
+
+    process_logger.info(f"Added the staged trips of {len(days)} day(s) to {DAY_PATH}")
+
+
+def process_new_trips(
+    test: bool = False, workers: int | None = None, force_patterns: bool = False
+) -> None:
     """
     1. Download data
     2. check for new patterns
@@ -135,6 +147,10 @@ def process_new_trips(test: bool = False) -> None:
     4. Make a new config file
     5. create a new xwalk
     6. Clear staging data
+
+    workers is the number of processes used to calculate stop times, defaults
+    to the number of cores. force_patterns rebuilds every pattern, even the
+    ones whose raw pattern did not change.
     """
 
     # 1 download data from ghost buses from max_date to today
@@ -162,7 +178,10 @@ def process_new_trips(test: bool = False) -> None:
     process_logger.info(
         f"Trying to download ghost bus data from data from {start_date} to {today_minus_one}"
     )
-    check = update_data(start_date, today)
+    with span("update_data") as record:
+        check = update_data(start_date, today)
+        record["rows_in"] = count_rows(f"{STAGING_PATH}/days/*.parquet")
+        record["rows_out"] = count_rows(f"{STAGING_PATH}/pids/*/*.parquet")
 
     if not check:
         create_config()
@@ -174,7 +193,10 @@ def process_new_trips(test: bool = False) -> None:
     process_logger.info(
         "Attempting to find and download any missing patterns from new data"
     )
-    update_patterns(EXISTING_PATTERNS)
+    with span("update_patterns") as record:
+        record["rows_in"], record["rows_out"] = update_patterns(
+            EXISTING_PATTERNS, force=force_patterns
+        )
 
     process_logger.info("Processing new trips")
 
@@ -183,7 +205,12 @@ def process_new_trips(test: bool = False) -> None:
     # 3 calculate the stop time for all the patterns
     # puts the processed trips by pattern in staging/trips
 
-    calculate_patterns(all_pids_df["pid"].astype(str).tolist())
+    with span("calculate_patterns", pids=len(all_pids_df)) as record:
+        record["rows_in"] = count_rows(f"{STAGING_PATH}/pids/*/*.parquet")
+        calculate_patterns(all_pids_df["pid"].astype(str).tolist(), workers=workers)
+        record["rows_out"] = count_rows(
+            f"{STAGING_PATH}/trips/*/trips_*_{today}.parquet"
+        )
 
     # recreate updated config file
     create_config()
@@ -1,13 +1,14 @@
 import polars as pl
-from metrics_utils import group_metrics
+from datetime import date
+from metrics_utils import group_metrics, group_metrics_months, sketch_quantiles
 
 # Functions -------------------------------------------------------------------
 
 
 def time_to_next_stop(
-    trips_df: pl.DataFrame,
+    trips_df: pl.LazyFrame,
     is_daytime: bool = True,
-) -> pl.DataFrame:
+) -> pl.LazyFrame:
     """
     calculate time to next stop and other metrics for each bus stop
     """
@@ -78,9 +79,12 @@ def join_metrics(all_metrics: list[pl.DataFrame]) -> pl.DataFrame:
     return static
 
 
-def create_route_metrics_df(route_df: pl.DataFrame, is_schedule: bool) -> pl.DataFrame:
+def prepare_route_metrics(
+    route_df: pl.LazyFrame, is_schedule: bool
+) -> tuple[pl.DataFrame, list[str]]:
     """
-    create stop metrics for one route
+    calculate the stop metrics of each row of one route, named for actual or
+    schedule. Returns the df and the names of the metrics
     """
 
     trips_df = time_to_next_stop(route_df)
@@ -102,7 +106,6 @@ def create_route_metrics_df(route_df: pl.DataFrame, is_schedule: bool) -> pl.Dat
         )
 
     # find grouped metrics for depending on actual or schedule
-    all_metrics = []
     metrics = [
         "time_till_next_bus",
         "time_to_previous_stop",
@@ -111,37 +114,64 @@ def create_route_metrics_df(route_df: pl.DataFrame, is_schedule: bool) -> pl.Dat
     ]
     metrics = [f"schedule_{m}" if is_schedule else f"actual_{m}" for m in metrics]
 
-    for metric in metrics:
-        grouped = group_metrics(trips_df, metric)
-        all_metrics.append(grouped)
+    # only read and keep what group_metrics uses
+    trips_df = trips_df.select(
+        "rt",
+        "pid",
+        "stop_id",
+        "bus_stop_time",
+        *[m for m in metrics if "num_buses" not in m],
+    ).collect()
+
+    return trips_df, metrics
 
-    one_route = join_metrics(all_metrics)
+
+def create_route_metrics_df(
+    route_df: pl.LazyFrame, is_schedule: bool, months: list[date] | None = None
+) -> pl.DataFrame:
+    """
+    create stop metrics for one route. If months is given, only the periods
+    that include one of those months are created
+    """
+
+    trips_df, metrics = prepare_route_metrics(route_df, is_schedule)
+
+    if months is None:
+        one_route = group_metrics(trips_df, metrics)
+    else:
+        one_route = group_metrics_months(trips_df, metrics, months)
 
     return one_route
 
 
-def create_combined_metrics_stop_df(
-    scheduled_df: pl.DataFrame, actual_df: pl.DataFrame
+def create_route_sketches(
+    route_df: pl.LazyFrame, is_schedule: bool, accuracy: float
 ) -> pl.DataFrame:
     """
-    For all the routes, create a combined DataFrame with all the metrics for both scheduled and actual data.
+    create the monthly quantile sketches of all the stop metrics for one route
     """
 
-    combined_df = scheduled_df.join(
-        actual_df,
-        on=["rt", "pid", "stop_id", "period", "period_value"],
-        how="full",
-        coalesce=True,
-    )
-    # For the combined DataFrame calculate the average delay for till the next bus arrives at a given bus stop
-    combined_df = combined_df.with_columns(
-        time_till_next_bus_delay=(
-            pl.col("median_actual_time_till_next_bus")
-            - pl.col("median_schedule_time_till_next_bus")
-        )
-    )
+    trips_df, metrics = prepare_route_metrics(route_df, is_schedule)
+
+    return group_metrics(trips_df, metrics, sketch_accuracy=accuracy)
+
+
+def route_metrics_from_sketches(
+    sketches_df: pl.DataFrame, accuracy: float
+) -> pl.DataFrame:
+    """
+    create stop metrics for one route from its sketches, same columns as
+    create_route_metrics_df
+    """
+
+    all_metrics = []
+    for metric in sketches_df["metric"].unique(maintain_order=True):
+        sketches = sketches_df.filter(pl.col("metric") == metric).drop("metric")
+        all_metrics.append(sketch_quantiles(sketches, metric, accuracy))
 
-    return combined_df
+    one_route = join_metrics(all_metrics)
+
+    return one_route
 
 
 # End -------------------------------------------------------------------------
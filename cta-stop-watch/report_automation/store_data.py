@@ -27,6 +27,19 @@ def store_folder_data(
     return True
 
 
+def sync_folder_data(s3_path: str, folder_path: str, s3_location: str) -> bool:
+    """
+    Mirror folder_path, subfolders included, to s3_location. Files that are no
+    longer in folder_path (e.g. compacted parts) are deleted from s3_location
+    """
+
+    command = f"gsutil -m rsync -r -d {folder_path} {s3_path}/{s3_location}"
+    print(command)
+    subprocess.run(command, shell=True)
+
+    return True
+
+
 def store_file(
     s3_path: str, file_path: str, s3_location: str, type: str = "cp"
 ) -> bool:
@@ -47,7 +60,7 @@ def store_all_data() -> None:
     """
     today = str(date.today())
 
-    store_folder_data(s3_path, "data/processed_by_pid", "processed_by_pid/", type="cp")
+    sync_folder_data(s3_path, "data/processed_by_pid", "processed_by_pid")
     store_folder_data(s3_path, "data/patterns/patterns_raw", "patterns_raw/", type="cp")
     store_folder_data(s3_path, "data/clean_timetables", "clean_timetables/", type="cp")
 
@@ -0,0 +1,195 @@
+import pathlib
+import os
+import json
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Iterator
+import polars as pl
+from utils import sample_peak_rss
+
+# Constants -------------------------------------------------------------------
+
+# Paths
+DIR = pathlib.Path(__file__).parent / "data"
+RUN_LOG = DIR / "telemetry" / "spans.jsonl"
+
+# spawned workers inherit the run id of the pipeline run through this
+RUN_ID_VAR = "STOPWATCH_RUN_ID"
+
+# Functions -------------------------------------------------------------------
+
+
+def run_id() -> str:
+    """
+    id of the current pipeline run, the time the pipeline was started
+    """
+
+    if RUN_ID_VAR not in os.environ:
+        os.environ[RUN_ID_VAR] = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+
+    return os.environ[RUN_ID_VAR]
+
+
+@contextmanager
+def span(stage: str, **fields) -> Iterator[dict]:
+    """
+    time a stage of the pipeline and append it as a json line to RUN_LOG with
+    its wall time and the peak memory of the process while it ran. Yields the
+    record, so the block can fill rows_in and rows_out or add fields
+
+    Arguments:
+        - stage: name of the stage, e.g. "calculate_pattern"
+        - fields: pid, rt or anything else that identifies the span
+    """
+
+    record = {
+        "run_id": run_id(),
+        "stage": stage,
+        "pid": None,
+        "rt": None,
+        "rows_in": None,
+        "rows_out": None,
+        **fields,
+        "start": datetime.now().isoformat(timespec="seconds"),
+    }
+
+    start = time.perf_counter()
+    record["status"] = "error"
+
+    try:
+        with sample_peak_rss(stage, logger=None) as peak:
+            yield record
+        record["status"] = "ok"
+    finally:
+        record["seconds"] = round(time.perf_counter() - start, 3)
+        record["peak_rss_mb"] = round(peak["rss"] / 2**20, 1)
+        write_span(record)
+
+
+def write_span(record: dict) -> None:
+    """
+    append a span to RUN_LOG. One write per line, so workers can append to
+    the same file
+    """
+
+    os.makedirs(RUN_LOG.parent, exist_ok=True)
+
+    line = json.dumps(record, default=str) + "\n"
+    with open(RUN_LOG, "a") as file:
+        file.write(line)
+
+
+def read_spans() -> pl.DataFrame:
+    """
+    all the spans in RUN_LOG, ids as strings. Empty if no span was recorded
+    """
+
+    if not RUN_LOG.exists():
+        return pl.DataFrame()
+
+    spans = pl.read_ndjson(RUN_LOG, infer_schema_length=None)
+
+    return spans.with_columns(pl.col("pid", "rt").cast(pl.String))
+
+
+def summarize_spans(spans: pl.DataFrame, keys: list[str]) -> pl.DataFrame:
+    """
+    totals of the spans of each run by keys
+    """
+
+    # rows stay null for stages that don't count them
+    rows = [
+        pl.when(pl.col(col).is_not_null().any()).then(pl.col(col).sum()).alias(col)
+        for col in ["rows_in", "rows_out"]
+    ]
+
+    return spans.group_by(["run_id", *keys]).agg(
+        pl.len().alias("spans"),
+        (pl.col("status") == "error").sum().alias("errors"),
+        pl.col("seconds").sum(),
+        *rows,
+        pl.col("peak_rss_mb").max(),
+    )
+
+
+def summary_report(run: str | None = None, top: int = 10) -> pl.DataFrame:
+    """
+    print the stages of a run (the last one by default) next to the run
+    before it, and the pids and routes that slowed down the most. Returns the
+    stage summary
+
+    Arguments:
+        - run: run_id to report on
+        - top: number of pids and routes to show
+    """
+
+    spans = read_spans()
+    if spans.is_empty():
+        print(f"No spans recorded in {RUN_LOG}")
+        return spans
+
+    runs = spans["run_id"].unique().sort().to_list()
+    run = run or runs[-1]
+    previous = [r for r in runs if r < run]
+    previous = previous[-1] if previous else None
+
+    stages = summarize_spans(spans, ["stage"])
+    current = stages.filter(pl.col("run_id") == run).drop("run_id")
+    before = stages.filter(pl.col("run_id") == previous).select(
+        "stage", pl.col("seconds").alias("seconds_before")
+    )
+
+    report = (
+        current.join(before, on="stage", how="left")
+        .with_columns(
+            (pl.col("rows_in") / pl.col("seconds")).round(0).alias("rows_in_per_sec"),
+            ((pl.col("seconds") / pl.col("seconds_before") - 1) * 100)
+            .round(1)
+            .alias("change_pct"),
+        )
+        .sort("seconds", descending=True)
+    )
+
+    with pl.Config(tbl_rows=-1, tbl_cols=-1, tbl_width_chars=200):
+        print(f"Run {run}, compared to {previous}")
+        print(report)
+
+        if previous is None:
+            return report
+
+        for key in ["pid", "rt"]:
+            by_key = summarize_spans(
+                spans.filter(pl.col(key).is_not_null()), ["stage", key]
+            )
+            slower = (
+                by_key.filter(pl.col("run_id") == run)
+                .join(
+                    by_key.filter(pl.col("run_id") == previous).select(
+                        "stage", key, pl.col("seconds").alias("seconds_before")
+                    ),
+                    on=["stage", key],
+                )
+                .with_columns(
+                    (pl.col("seconds") - pl.col("seconds_before")).alias("slower_by")
+                )
+                .sort("slower_by", descending=True)
+                .select("stage", key, "seconds_before", "seconds", "slower_by")
+                .head(top)
+            )
+            if slower.height:
+                print(f"Slowest {key}s compared to {previous}")
+                print(slower)
+
+    return report
+
+
+# start the run when the pipeline is loaded, before any workers are spawned
+run_id()
+
+# Implementation --------------------------------------------------------------
+
+if __name__ == "__main__":
+    summary_report()
+
+# End -------------------------------------------------------------------------
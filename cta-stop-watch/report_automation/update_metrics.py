@@ -1,25 +1,54 @@
-from stop_metrics import create_route_metrics_df, create_combined_metrics_stop_df
-from metrics_utils import create_trips_df
+from stop_metrics import (
+    create_route_metrics_df,
+    create_route_sketches,
+    route_metrics_from_sketches,
+)
+from metrics_utils import (
+    SKETCH_DIR,
+    YEAR_PERIODS,
+    create_trips_df,
+    processed_trip_files,
+    record_changed_partitions,
+    read_changed_partitions,
+    clear_changed_partitions,
+    recalculated_months,
+)
 from utils import metrics_logger, clear_staging
+from telemetry import span
 import polars as pl
 import pandas as pd
 import os
+import re
+import shutil
 import pathlib
 import duckdb
-from memory_profiler import profile
+from datetime import date, timedelta
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from multiprocessing import get_context
 
 # Contants --------------------------------------------------------------------
 
 # Paths
 DIR = pathlib.Path(__file__).parent
 OUT_DIR = DIR / "data" / "metrics"
+PROCESSED_DIR = DIR / "data" / "processed_by_pid"
+LAST_RUN_FILE = OUT_DIR / "last_run_month.txt"
+
+# rough peak memory of the metrics of a route per row of its trips, caps how
+# many routes are calculated at once
+ROUTE_ROW_BYTES = 400
+
+# memory duckdb uses to combine the route metrics before spilling to disk
+MEMORY_LIMIT = "4GB"
 
 # Functions -------------------------------------------------------------------
 
 
 def combine_recent_trips() -> None:
     """
-    take whats in staging/trips combine it with processes_by_pid
+    take whats in staging/trips and append it to processes_by_pid. New trips
+    are written as new part files in processed_by_pid/pid={pid}/date=YYYY-MM/
+    so the history is never rewritten, see compact_processed_trips
     """
 
     # get all the pids in the staging/trips
@@ -37,7 +66,8 @@ def combine_recent_trips() -> None:
            COUNT(DISTINCT pid) as total_pids,
            count(distinct CAST(bus_stop_time AS DATE)) as total_days,
            max(CAST(bus_stop_time AS DATE)) as max_date
-    from read_parquet('data/processed_by_pid/*.parquet')"""
+    from read_parquet('data/processed_by_pid/**/*.parquet',
+                      union_by_name = true, hive_partitioning = false)"""
 
     stats_before = duckdb.execute(stats_command).df()
 
@@ -49,29 +79,24 @@ def combine_recent_trips() -> None:
         The max date is {stats_before['max_date'].to_list()[0]}."""
     )
 
+    # keep track of the months each route got new trips for
+    if pids:
+        changes_command = """
+        SELECT DISTINCT rt,
+               CAST(date_trunc('month', bus_stop_time) AS DATE) AS month
+        FROM read_parquet('data/staging/trips/*/*.parquet')"""
+        record_changed_partitions(duckdb.execute(changes_command).pl())
+
     for pid in pids:
-        if os.path.exists(f"{DIR}/data/processed_by_pid/trips_{pid}_full.parquet"):
-            # combine all the files together
-            command = f"""COPY 
-                            (SELECT * 
-                            FROM read_parquet('data/staging/trips/{pid}/*')
-                            UNION ALL
-                            SELECT *
-                            from read_parquet('data/processed_by_pid/trips_{pid}_full.parquet')
-                            )  
-                            TO 'data/processed_by_pid/trips_{pid}_full.parquet' (FORMAT 'parquet');
-            """
-            duckdb.execute(command)
-
-        else:
-            # copy over to storage folder
-            # grab all days from the folder
-            command = f"""COPY 
-                            (SELECT * 
-                            FROM read_parquet('data/staging/trips/{pid}/*'))  
-                            TO 'data/processed_by_pid/trips_{pid}_full.parquet' (FORMAT 'parquet');
-            """
-            duckdb.execute(command)
+        # one new part per month of the staged trips
+        command = f"""COPY
+                        (SELECT *, strftime(bus_stop_time, '%Y-%m') AS date
+                        FROM read_parquet('data/staging/trips/{pid}/*'))
+                        TO 'data/processed_by_pid/pid={pid}'
+                        (FORMAT 'parquet', PARTITION_BY (date), APPEND true,
+                        FILENAME_PATTERN 'part-{{uuid}}');
+        """
+        duckdb.execute(command)
 
     # stats after merging
     stats_after = duckdb.execute(stats_command).df()
@@ -85,136 +110,545 @@ def combine_recent_trips() -> None:
     )
 
 
-@profile
-def update_metrics(rts: list[str] | str = "all") -> bool:
+def compact_processed_trips(pids: list[str] | None = None) -> None:
     """
-    combine new trips and then calculate new metrics
+    rewrite the parts appended for each pid as one file per month. Also moves
+    old processed_by_pid/trips_{pid}_full.parquet files into the new layout
 
     Arguments:
-        - rts: Can either be a list with the specific routes to be processed
-        (represented as strings) or the string value "all" for processing
-        all available routes.
+        - pids: the pids to compact, all pids in processed_by_pid by default
+    """
 
-    Returns: a boolean to confirm execution and writes data sets
+    if pids is None:
+        pids = set()
+        for name in os.listdir(PROCESSED_DIR):
+            found = re.fullmatch(r"pid=(\d+)|trips_(\d+)_full\.parquet", name)
+            if found:
+                pids.add(found.group(1) or found.group(2))
+        pids = sorted(pids)
+
+    for pid in pids:
+        files = processed_trip_files(pid)
+        if not files:
+            continue
+
+        pid_dir = PROCESSED_DIR / f"pid={pid}"
+        new_dir = PROCESSED_DIR / f"pid={pid}.compact"
+        old_dir = PROCESSED_DIR / f"pid={pid}.old"
+        shutil.rmtree(new_dir, ignore_errors=True)
+
+        file_list = ", ".join(f"'{f}'" for f in files)
+        command = f"""COPY
+                        (SELECT *, strftime(bus_stop_time, '%Y-%m') AS date
+                        FROM read_parquet([{file_list}],
+                            union_by_name = true, hive_partitioning = false))
+                        TO '{new_dir}'
+                        (FORMAT 'parquet', PARTITION_BY (date),
+                        FILENAME_PATTERN 'part-{{i}}');
+        """
+        duckdb.execute(command)
+
+        # swap the compacted folder in and remove the old files
+        if pid_dir.exists():
+            pid_dir.rename(old_dir)
+        new_dir.rename(pid_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+        (PROCESSED_DIR / f"trips_{pid}_full.parquet").unlink(missing_ok=True)
+
+        metrics_logger.debug(f"Compacted {len(files)} files for pattern {pid}")
+
+    metrics_logger.info(f"Compacted processed trips for {len(pids)} patterns")
+
+
+def create_route_metrics(
+    rt: str,
+    is_schedule: bool,
+    months: list[date] | None,
+    sketch_accuracy: float | None,
+) -> pl.DataFrame:
     """
+    stop metrics for one route. Exact from the trips, or from the stored
+    sketches of the route after replacing the sketches of months with new ones
 
-    # metric states before
-    if os.path.exists(f"{OUT_DIR}/stop_metrics_df.parquet"):
-        mertics_df = pd.read_parquet(f"{OUT_DIR}/stop_metrics_df.parquet")
-        total_rows = mertics_df.shape[0]
-        total_months = mertics_df[mertics_df["period"] == "month_abs"][
-            "period_value"
-        ].nunique()
-        max_month = mertics_df[mertics_df["period"] == "month_abs"][
-            "period_value"
-        ].max()
-        # max month of actual data
-        max_month_actual = mertics_df[
-            (mertics_df["period"] == "month_abs")
-            & (mertics_df["median_actual_time_till_next_bus"].notna())
-        ]["period_value"].max()
-
-        metrics_logger.info(
-            f"""Before updating metrics, there were {total_rows:,} rows, 
-            and {total_months:,} unique months. 
-            The max month is {max_month}.
-            The max actual month is {max_month_actual}
-            """
-        )
-    else:
-        metrics_logger.info("No metrics file found")
+    Arguments:
+        - rt: the route
+        - is_schedule: metrics for the schedule or the actual trips
+        - months: the months that changed, None to use all the trips
+        - sketch_accuracy: relative accuracy of the sketches, None for exact
+    """
 
-    if rts == "all":
-        xwalk = pd.read_parquet("data/rt_to_pid.parquet")
-        rts = xwalk["rt"].unique().tolist()
+    if sketch_accuracy is None:
+        trips_df = create_trips_df(rt=rt, is_schedule=is_schedule)
+        return create_route_metrics_df(trips_df, is_schedule=is_schedule, months=months)
 
-    rts_count = 0
+    kind = "schedule" if is_schedule else "actual"
+    sketch_file = SKETCH_DIR / f"accuracy={sketch_accuracy}" / kind / f"rt{rt}.parquet"
 
-    # create staging folders
-    if not os.path.exists(OUT_DIR / "staging_actual"):
-        os.mkdir(OUT_DIR / "staging_actual")
-    if not os.path.exists(OUT_DIR / "staging_sched"):
-        os.mkdir(OUT_DIR / "staging_sched")
+    if months is None or not sketch_file.exists():
+        # no sketches to update, create them from all the trips
+        trips_df = create_trips_df(rt=rt, is_schedule=is_schedule)
+        sketches_df = create_route_sketches(trips_df, is_schedule, sketch_accuracy)
+    else:
+        # the last buses of the month before a changed month wait for buses in
+        # it, and the last buses of a changed month wait for the month after
+        following = [(month + timedelta(days=32)).replace(day=1) for month in months]
+        recalculate = recalculated_months(months)
 
-    for rt in rts:
-        # prep schedule and actual
-        metrics_logger.debug(f"Processing route {rt}")
+        sketches_df = pl.read_parquet(sketch_file).filter(
+            ~pl.col("data_month").is_in(recalculate)
+        )
         try:
-            actual_df = create_trips_df(rt=rt, is_schedule=False)
+            trips_df = create_trips_df(
+                rt=rt,
+                is_schedule=is_schedule,
+                months=sorted(set(recalculate) | set(following)),
+            )
+            new_sketches = create_route_sketches(trips_df, is_schedule, sketch_accuracy)
+            new_sketches = new_sketches.filter(pl.col("data_month").is_in(recalculate))
+            sketches_df = pl.concat([sketches_df, new_sketches])
+        except ValueError:
+            metrics_logger.debug(f"No {kind} trips for route {rt} in changed months")
+
+    sketch_file.parent.mkdir(parents=True, exist_ok=True)
+    sketches_df.write_parquet(sketch_file)
+
+    return route_metrics_from_sketches(sketches_df, sketch_accuracy)
+
+
+def store_route_metrics(
+    rt: str,
+    months: list[date] | None,
+    sketch_accuracy: float | None,
+    rows: dict[str, int] | None = None,
+) -> bool:
+    """
+    calculate the actual and schedule metrics of one route and write them to
+    the staging folders. Returns if both were written. rows are the rows of
+    trips of the route by kind (see route_rows) for the telemetry spans
+    """
 
-        except Exception as e:
-            metrics_logger.info(f"issue with rt {rt}: {e}")
-            continue
+    rows = rows or {}
+
+    # prep schedule and actual
+    metrics_logger.debug(f"Processing route {rt}")
+
+    try:
+        with span(
+            "route_metrics", rt=rt, kind="actual", rows_in=rows.get("actual")
+        ) as record:
+            route_metrics_actual = create_route_metrics(
+                rt, False, months, sketch_accuracy
+            )
+            record["rows_out"] = route_metrics_actual.height
+    except Exception as e:
+        metrics_logger.info(f"issue with rt {rt}: {e}")
+        return False
+
+    # write out to file
+    route_metrics_actual.write_parquet(
+        f"{OUT_DIR}/staging_actual/route{rt}_metrics_actual.parquet"
+    )
 
-        route_metrics_actual = create_route_metrics_df(actual_df, is_schedule=False)
+    del route_metrics_actual
+
+    try:
+        with span(
+            "route_metrics", rt=rt, kind="schedule", rows_in=rows.get("schedule")
+        ) as record:
+            route_metrics_schedule = create_route_metrics(
+                rt, True, months, sketch_accuracy
+            )
+            record["rows_out"] = route_metrics_schedule.height
+    except Exception as e:
+        metrics_logger.info(f"issue with rt {rt}: {e}")
+        return False
+
+    # write out to file
+    route_metrics_schedule.write_parquet(
+        f"{OUT_DIR}/staging_sched/route{rt}_metrics_schedule.parquet"
+    )
 
-        # write out to file
-        route_metrics_actual.write_parquet(
-            f"{OUT_DIR}/staging_actual/route{rt}_metrics_actual.parquet"
-        )
+    return True
 
-        del route_metrics_actual
 
-        try:
-            schedule_df = create_trips_df(rt=rt, is_schedule=True)
-        except Exception as e:
-            metrics_logger.info(f"issue with rt {rt}: {e}")
-            continue
+def parquet_rows(file: str) -> int:
+    """
+    number of rows of a parquet file, from its metadata
+    """
 
-        route_metrics_schedule = create_route_metrics_df(schedule_df, is_schedule=True)
-        # create the stop level data
+    return pl.scan_parquet(file).select(pl.len()).collect().item()
 
-        # write out to file
-        route_metrics_schedule.write_parquet(
-            f"{OUT_DIR}/staging_sched/route{rt}_metrics_schedule.parquet"
-        )
 
-        del route_metrics_schedule
+def route_rows(rt: str, pids: list[str]) -> dict[str, int]:
+    """
+    rows of all the processed trips ("actual") and of the timetable
+    ("schedule") of a route, from the parquet metadata
+    """
+
+    actual = sum(parquet_rows(f) for pid in pids for f in processed_trip_files(pid))
 
-        rts_count += 1
-        if rts_count % 40 == 0:
-            metrics_logger.info(f"{round((rts_count/len(rts)) * 100,3)} complete")
+    timetable = DIR / "data" / "clean_timetables" / f"rt{rt}_timetable.parquet"
+    schedule = parquet_rows(timetable) if timetable.exists() else 0
 
-    # combine stop level at routes
-    a_command = f""" select *
-                    from read_parquet('{OUT_DIR}/staging_actual/*.parquet')
-                    """
-    actual_full_stops = duckdb.execute(a_command).pl()
+    return {"actual": actual, "schedule": schedule}
 
-    s_command = f""" select *
-                    from read_parquet('{OUT_DIR}/staging_sched/*.parquet')
-                    """
-    actual_full_stops = duckdb.execute(a_command).pl()
 
-    schedule_full_stops = duckdb.execute(s_command).pl()
+def available_memory() -> int:
+    """
+    bytes of memory available for new processes
+    """
 
-    stop_metrics = create_combined_metrics_stop_df(
-        actual_full_stops, schedule_full_stops
+    try:
+        with open("/proc/meminfo") as file:
+            for line in file:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES")
+
+
+def calculate_routes(
+    rts: list[str],
+    months: dict[str, list[date]],
+    sketch_accuracy: float | None,
+    workers: int | None = None,
+) -> list[str]:
+    """
+    write the metrics of every route to staging, see store_route_metrics.
+    Returns the routes that were written
+
+    Arguments:
+        - rts: the routes to calculate
+        - months: the changed months of each route, routes that are not in it
+        use all their trips
+        - sketch_accuracy: relative accuracy of the sketches, None for exact
+        - workers: number of processes to fan the routes out to. Defaults to
+        the number of cores, 1 runs everything in this process. Routes only
+        start while the estimated memory of the routes in flight fits in the
+        available memory, see ROUTE_ROW_BYTES
+    """
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    updated_rts = []
+
+    xwalk = pd.read_parquet("data/rt_to_pid.parquet")
+    pids = xwalk.groupby("rt")["pid"].unique()
+    rows = {rt: route_rows(rt, pids.get(rt, [])) for rt in rts}
+
+    if workers <= 1 or len(rts) <= 1:
+        for rts_count, rt in enumerate(rts, start=1):
+            if store_route_metrics(rt, months.get(rt), sketch_accuracy, rows[rt]):
+                updated_rts.append(rt)
+            if rts_count % 40 == 0:
+                metrics_logger.info(f"{round((rts_count/len(rts)) * 100,3)} complete")
+
+        return updated_rts
+
+    # the actual and schedule metrics of a route are not calculated at once
+    size = {rt: max(rows[rt].values()) for rt in rts}
+    max_rows = available_memory() // ROUTE_ROW_BYTES
+
+    metrics_logger.info(
+        f"Calculating {len(rts)} routes with {workers} workers, "
+        f"up to {max_rows:,} rows at once"
     )
 
-    # export
-    stop_metrics.write_parquet(f"{OUT_DIR}/stop_metrics_df.parquet")
+    # biggest routes first, so they don't run alone at the end
+    queue = sorted(rts, key=size.get, reverse=True)
+    in_flight = {}
+    rts_count = 0
 
-    # metric states after
-    mertics_df = pd.read_parquet(f"{OUT_DIR}/stop_metrics_df.parquet")
-    total_rows = mertics_df.shape[0]
-    total_months = mertics_df[mertics_df["period"] == "month_abs"][
-        "period_value"
-    ].nunique()
-    max_month = mertics_df[mertics_df["period"] == "month_abs"]["period_value"].max()
-    # max month of actual data
-    max_month_actual = mertics_df[
-        (mertics_df["period"] == "month_abs")
-        & (mertics_df["median_actual_time_till_next_bus"].notna())
-    ]["period_value"].max()
+    # spawn, the parent has polars and duckdb thread pools that fork can't copy
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=get_context("spawn")
+    ) as executor:
+        while queue or in_flight:
+            # start the routes that fit, a route bigger than all the memory
+            # still runs on its own
+            while queue and len(in_flight) < workers:
+                rows_in_flight = sum(size[rt] for rt in in_flight.values())
+                fits = [
+                    rt
+                    for rt in queue
+                    if not in_flight or rows_in_flight + size[rt] <= max_rows
+                ]
+                if not fits:
+                    break
+
+                rt = fits[0]
+                queue.remove(rt)
+                future = executor.submit(
+                    store_route_metrics,
+                    rt,
+                    months.get(rt),
+                    sketch_accuracy,
+                    rows[rt],
+                )
+                in_flight[future] = rt
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                rt = in_flight.pop(future)
+                try:
+                    if future.result():
+                        updated_rts.append(rt)
+                except Exception as e:
+                    metrics_logger.info(f"issue with rt {rt}: {e}")
+
+                rts_count += 1
+                if rts_count % 40 == 0:
+                    metrics_logger.info(
+                        f"{round((rts_count/len(rts)) * 100,3)} complete"
+                    )
+
+    return updated_rts
+
+
+def log_metrics_state(when: str) -> None:
+    """
+    log the rows and months of stop_metrics_df.parquet without loading it
+    """
+
+    command = f"""
+            SELECT  COUNT(*) AS total_rows,
+                    COUNT(DISTINCT period_value)
+                        FILTER (WHERE period = 'month_abs') AS total_months,
+                    MAX(period_value)
+                        FILTER (WHERE period = 'month_abs') AS max_month,
+                    MAX(period_value)
+                        FILTER (WHERE period = 'month_abs'
+                                AND median_actual_time_till_next_bus IS NOT NULL)
+                        AS max_month_actual
+            FROM    read_parquet('{OUT_DIR}/stop_metrics_df.parquet')"""
+
+    total_rows, total_months, max_month, max_month_actual = duckdb.execute(
+        command
+    ).fetchone()
 
     metrics_logger.info(
-        f"""After updating metrics, there were {total_rows:,} rows, 
+        f"""{when} updating metrics, there were {total_rows:,} rows, 
         and {total_months:,} unique months. 
         The max month is {max_month}.
         The max actual month is {max_month_actual}"""
     )
 
+
+def last_full_month() -> date:
+    """
+    first day of the last full month, the month of the last_full_month period
+    """
+
+    return (date.today().replace(day=1) - timedelta(days=1)).replace(day=1)
+
+
+def new_month_since_last_run() -> bool:
+    """
+    if the metrics were last updated in an earlier month, so the last full
+    month of every route moved on. Also True if no run was recorded
+    """
+
+    if not LAST_RUN_FILE.exists():
+        return True
+
+    return LAST_RUN_FILE.read_text().strip() < date.today().strftime("%Y-%m")
+
+
+def record_run_month() -> None:
+    LAST_RUN_FILE.parent.mkdir(parents=True, exist_ok=True)
+    LAST_RUN_FILE.write_text(date.today().strftime("%Y-%m"))
+
+
+def combine_route_metrics(
+    incremental: bool,
+    memory_limit: str = MEMORY_LIMIT,
+    months: dict[str, list[date]] | None = None,
+) -> None:
+    """
+    join the staged actual and schedule metrics of the routes into
+    stop_metrics_df.parquet without loading them in memory. duckdb spills to
+    data/metrics/tmp past memory_limit. With incremental the recalculated
+    periods of the routes replace theirs in the existing stop_metrics_df
+
+    Arguments:
+        - incremental: merge into the existing stop_metrics_df
+        - memory_limit: memory duckdb can use before spilling to disk
+        - months: the changed months of each recalculated route. Their
+        last_full_month, the month_abs of these months, of the months before
+        them and of the last full month, and the year periods of their years
+        are replaced even if the route has no trips in them anymore
+    """
+
+    months = months or {}
+
+    # the periods of the recalculated routes that are replaced, see
+    # group_metrics_months
+    replaced_months = pl.DataFrame(
+        [
+            (rt, month.strftime("%Y-%m"))
+            for rt, rt_months in months.items()
+            for month in {*recalculated_months(rt_months), last_full_month()}
+        ],
+        schema={"rt": pl.String, "month": pl.String},
+        orient="row",
+    )
+    replaced_years = pl.DataFrame(
+        [
+            (rt, str(year))
+            for rt, rt_months in months.items()
+            for year in {month.year for month in recalculated_months(rt_months)}
+        ],
+        schema={"rt": pl.String, "year": pl.String},
+        orient="row",
+    )
+    year_periods = ", ".join(f"'{period}'" for period in YEAR_PERIODS)
+
+    out_file = f"{OUT_DIR}/stop_metrics_df.parquet"
+    new_file = f"{OUT_DIR}/stop_metrics_df_new.parquet"
+    merged_file = f"{OUT_DIR}/stop_metrics_df_merged.parquet"
+
+    with duckdb.connect() as con:
+        con.execute(f"SET memory_limit = '{memory_limit}'")
+        con.execute(f"SET temp_directory = '{OUT_DIR}/tmp'")
+        con.execute("SET preserve_insertion_order = false")
+
+        # average delay for till the next bus arrives at a given bus stop
+        command = f"""COPY (
+            SELECT  *,
+                    median_actual_time_till_next_bus
+                    - median_schedule_time_till_next_bus AS time_till_next_bus_delay
+            FROM    read_parquet('{OUT_DIR}/staging_actual/*.parquet') AS a
+            FULL JOIN read_parquet('{OUT_DIR}/staging_sched/*.parquet') AS s
+            USING   (rt, pid, stop_id, period, period_value)
+            ) TO '{new_file}' (FORMAT 'parquet')"""
+        con.execute(command)
+
+        if incremental:
+            # replace the recalculated periods of the routes, keep everything
+            # else. Only the recalculated routes are merged: a route whose
+            # schedule failed has staged actual metrics only, and keeps its own
+            con.register("replaced_months", replaced_months)
+            con.register("replaced_years", replaced_years)
+            recalculated = f"""(
+                SELECT  *
+                FROM    read_parquet('{new_file}')
+                WHERE   rt IN (SELECT rt FROM replaced_months))"""
+            command = f"""COPY (
+                SELECT  p.*
+                FROM    read_parquet('{out_file}') AS p
+                ANTI JOIN (
+                    SELECT  DISTINCT rt, period, period_value
+                    FROM    {recalculated}
+                ) AS n
+                USING   (rt, period, period_value)
+                WHERE   NOT (
+                    p.rt IN (SELECT rt FROM replaced_months)
+                    AND p.period = 'last_full_month')
+                AND     NOT EXISTS (
+                    SELECT  1
+                    FROM    replaced_months AS m
+                    WHERE   m.rt = p.rt
+                    AND     p.period = 'month_abs'
+                    AND     left(p.period_value, 7) = m.month)
+                AND     NOT EXISTS (
+                    SELECT  1
+                    FROM    replaced_years AS y
+                    WHERE   y.rt = p.rt
+                    AND     p.period IN ({year_periods})
+                    AND     left(p.period_value, 4) = y.year)
+                UNION ALL BY NAME
+                SELECT  *
+                FROM    {recalculated}
+                ) TO '{merged_file}' (FORMAT 'parquet')"""
+            con.execute(command)
+            os.replace(merged_file, new_file)
+
+    os.replace(new_file, out_file)
+
+
+def update_metrics(
+    rts: list[str] | str = "all",
+    incremental: bool = False,
+    sketch_accuracy: float | None = None,
+    workers: int | None = None,
+    memory_limit: str = MEMORY_LIMIT,
+) -> bool:
+    """
+    combine new trips and then calculate new metrics
+
+    Arguments:
+        - rts: Can either be a list with the specific routes to be processed
+        (represented as strings) or the string value "all" for processing
+        all available routes.
+        - incremental: only recalculate the routes and periods that got new
+        trips or schedule rows since the last run and merge them into the
+        existing stop_metrics_df.parquet
+        - sketch_accuracy: take the medians and quantiles from sketches kept
+        in data/metrics/sketches, so incremental runs only read the trips of
+        the changed months. Quantiles are within this relative accuracy of the
+        exact ones (twice for bus counts by year). None for exact metrics
+        - workers: number of processes the routes are calculated in, see
+        calculate_routes
+        - memory_limit: memory duckdb can use to combine the metrics of the
+        routes before spilling to disk, e.g. "4GB"
+
+    Returns: a boolean to confirm execution and writes data sets
+    """
+
+    # metric states before
+    if os.path.exists(f"{OUT_DIR}/stop_metrics_df.parquet"):
+        log_metrics_state("Before")
+    else:
+        metrics_logger.info("No metrics file found")
+
+    if incremental and not os.path.exists(f"{OUT_DIR}/stop_metrics_df.parquet"):
+        metrics_logger.info("No metrics to update, recalculating all the metrics")
+        incremental = False
+
+    changed = read_changed_partitions()
+
+    if rts == "all":
+        xwalk = pd.read_parquet("data/rt_to_pid.parquet")
+        rts = xwalk["rt"].unique().tolist()
+
+    # the last full month of every route moves on with the month
+    if incremental and new_month_since_last_run():
+        metrics_logger.info("New month since the last run, updating every route")
+        record_changed_partitions(
+            pl.DataFrame({"rt": rts, "month": [last_full_month()] * len(rts)})
+        )
+        changed = read_changed_partitions()
+
+    if incremental:
+        rts = [rt for rt in rts if rt in changed]
+        metrics_logger.info(f"Updating metrics for {len(rts)} changed routes")
+        if not rts:
+            return True
+
+    # create staging folders
+    if not os.path.exists(OUT_DIR / "staging_actual"):
+        os.mkdir(OUT_DIR / "staging_actual")
+    if not os.path.exists(OUT_DIR / "staging_sched"):
+        os.mkdir(OUT_DIR / "staging_sched")
+
+    months = changed if incremental else {}
+    updated_rts = calculate_routes(rts, months, sketch_accuracy, workers)
+
+    # combine stop level at routes and export
+    with span("combine_route_metrics", routes=len(updated_rts)) as record:
+        combine_route_metrics(
+            incremental, memory_limit, {rt: months.get(rt, []) for rt in updated_rts}
+        )
+        record["rows_out"] = parquet_rows(f"{OUT_DIR}/stop_metrics_df.parquet")
+    clear_changed_partitions(updated_rts)
+    record_run_month()
+
+    # metric states after
+    log_metrics_state("After")
+
     clear_staging(folders=["metrics/staging_actual", "metrics/staging_sched"])
 
     return True
@@ -5,9 +5,11 @@ import gtfs_kit as gk
 import os
 import duckdb
 import numpy as np
+import polars as pl
 import requests
 from datetime import date
 from utils import metrics_logger
+from metrics_utils import record_changed_partitions
 
 warnings.simplefilter(action="ignore", category=FutureWarning)
 
@@ -29,55 +31,77 @@ def download_current_feed() -> bool:
     return True
 
 
-def process_route_timetable(
-    feed: gk.feed.Feed, route_id: str, dates: list[str], merged_df: pd.DataFrame, a
-) -> pd.DataFrame:
+def route_timetables(feed: gk.feed.Feed, rts: list[str]) -> dict[str, pl.DataFrame]:
+    """
+    Return the timetable of each route for all the dates of the feed, with the
+    columns written by create_timetables.
+
+    The trip activity of the feed is melted into one (trip_id, date) row per
+    day a trip runs and joined to the stop times of the trip, like
+    gtfs_kit.build_route_timetable but for all dates at once. Both sides are
+    split by route first, so each join only holds one route. Rows are sorted
+    by date, then in feed order.
     """
-    Return a timetable for the given route and dates (YYYYMMDD date strings).
-
-    Return a DataFrame with whose columns are all those in ``feed.trips`` plus those in
-    ``feed.stop_times`` plus ``'date'``.
-    The trip IDs are restricted to the given route ID.
-    The result is sorted first by date and then by grouping by
-    trip ID and sorting the groups by their first departure time.
 
-    Skip dates outside of the Feed's dates.
+    trips = pl.from_pandas(
+        feed.trips[["trip_id", "route_id", "service_id", "schd_trip_id", "shape_id"]]
+    ).filter(pl.col("route_id").is_in(rts))
 
-    If there is no route activity on the given dates, then return
-    an empty DataFrame.
+    stop_times = pl.from_pandas(
+        feed.stop_times[
+            ["trip_id", "stop_id", "stop_sequence", "arrival_time", "departure_time"]
+        ]
+    )
 
-    AS Notes: adapted from gtfs_kit.build_route_timetable to run multiple routes
-    and removing redundant code. Documentation here:
-    https://github.com/mrcagney/gtfs_kit/blob/master/gtfs_kit/routes.py#L643
-    """
-    dates = feed.subset_dates(dates)
-    if not dates:
-        return pd.DataFrame()
+    # one row per stop time, in the order of pd.merge(feed.trips, feed.stop_times)
+    merged = trips.join(stop_times, on="trip_id", maintain_order="left_right")
+    merged = merged.with_row_index("feed_order")
+
+    # one row per trip and date it runs
+    activity = (
+        pl.from_pandas(feed.compute_trip_activity(feed.get_dates()))
+        .unpivot(index="trip_id", variable_name="date", value_name="active")
+        .filter(pl.col("active") == 1)
+        .join(trips.select("trip_id", "route_id"), on="trip_id")
+        .select("route_id", "trip_id", "date")
+    )
 
-    t = merged_df[merged_df["route_id"] == route_id].copy()
+    merged_by_route = merged.partition_by("route_id", as_dict=True)
+    activity_by_route = activity.partition_by("route_id", as_dict=True)
 
-    frames = []
-    for day in dates:
-        # Slice to trips active on date
-        ids = a.loc[a[day] == 1, "trip_id"]
-        f = t[t["trip_id"].isin(ids)].copy()
-        f["date"] = day
-        # Groupby trip ID and sort groups by their minimum departure time.
-        # For some reason NaN departure times mess up the transform below.
-        # So temporarily fill NaN departure times as a workaround.
-        f["dt"] = f["departure_time"].fillna(method="ffill")
-        f["min_dt"] = f.groupby("trip_id")["dt"].transform(min)
-        frames.append(f)
+    timetables = {}
+    for (rt,), route_df in merged_by_route.items():
+        if (rt,) not in activity_by_route:
+            continue
 
-    f = pd.concat(frames)
+        timetables[rt] = (
+            route_df.join(
+                activity_by_route[(rt,)].drop("route_id"),
+                on="trip_id",
+            )
+            .sort("date", "feed_order")
+            .select(
+                "route_id",
+                pl.col("shape_id").str.slice(-5).alias("pid"),
+                "schd_trip_id",
+                "stop_id",
+                "stop_sequence",
+                "date",
+                "arrival_time",
+                "departure_time",
+                "service_id",
+                "trip_id",
+                pl.lit(None, dtype=pl.String).alias("sha1"),
+            )
+        )
 
-    return f.drop(["min_dt", "dt"], axis=1)
+    return timetables
 
 
 def create_timetables() -> bool:
     """
-    creates a time table from a feed for each route using the process_route_timetable
-    function, an adaption of gtfs_kit.build_route_timetable
+    creates a time table from a feed for each route with route_timetables,
+    a vectorized adaption of gtfs_kit.build_route_timetable
     """
     today = str(date.today())
     file = f"feed_{today}.zip"
@@ -86,52 +110,59 @@ def create_timetables() -> bool:
 
     feed = gk.read_feed(file_path, dist_units="m")  # in meters
     rts = feed.routes[feed.routes["route_short_name"].notna()]["route_id"]
-    all_dates = feed.get_dates()
 
-    rts_count = 0
+    metrics_logger.debug(f"creating timetables for {len(rts)} routes")
+    timetables = route_timetables(feed, rts.tolist())
 
-    # run full feed tables once and feed into process_route_timetable
-    merged_df = pd.merge(feed.trips, feed.stop_times)
-    a = feed.compute_trip_activity(all_dates)
+    if not os.path.exists("data/staging/timetables/current_timetables"):
+        os.makedirs("data/staging/timetables/current_timetables")
 
-    for rt in rts:
-        metrics_logger.debug(f"creating timetable for route {rt}")
+    # one file per route
+    for rt, timetables_df in timetables.items():
+        timetables_df.with_columns(fetched_date=pl.lit(today)).write_parquet(
+            f"data/staging/timetables/current_timetables/rt{rt}_timetable.parquet"
+        )
 
-        timetables_df = process_route_timetable(feed, rt, all_dates, merged_df, a)
-        timetables_df["pid"] = timetables_df["shape_id"].str.slice(-5)
+    metrics_logger.info(f"Created timetables for {len(timetables)} routes")
 
-        timetables_df = timetables_df[
-            [
-                "route_id",
-                "pid",
-                "schd_trip_id",
-                "stop_id",
-                "stop_sequence",
-                "date",
-                "arrival_time",
-                "departure_time",
-                "service_id",
-                "trip_id",
-            ]
-        ]
+    return True
 
-        timetables_df["sha1"] = None
-        timetables_df["fetched_date"] = today
 
-        rts_count += 1
+def timetable_months(timetable: pd.DataFrame) -> pd.Series:
+    """
+    start of the month of each row of a timetable
+    """
 
-        if rts_count % 40 == 0:
-            metrics_logger.info(f"{round((rts_count/len(rts)) * 100,3)} complete")
+    return timetable["bus_stop_time"].dt.to_period("M").dt.start_time
 
-        if not os.path.exists("data/staging/timetables/current_timetables"):
-            os.makedirs("data/staging/timetables/current_timetables")
 
-        timetables_df.to_parquet(
-            f"data/staging/timetables/current_timetables/rt{rt}_timetable.parquet",
-            index=False,
-        )
+def month_digests(timetable: pd.DataFrame, columns: list[str]) -> pd.Series:
+    """
+    hash of the rows of each month of a timetable, by the start of the month.
+    Rows are hashed as strings and summed, so the order of the rows does not
+    matter
+    """
 
-    return True
+    rows = pd.util.hash_pandas_object(timetable[columns].astype(str), index=False)
+
+    return rows.groupby(timetable_months(timetable).to_numpy()).sum()
+
+
+def changed_months(current: pd.DataFrame, replaced: pd.DataFrame) -> list:
+    """
+    months whose rows in the current schedule are not the same as the rows of
+    the historic schedule they replace
+    """
+
+    columns = sorted(current.columns)
+    if not set(columns) <= set(replaced.columns):
+        return list(timetable_months(current).dropna().unique())
+
+    before, after = month_digests(replaced, columns).align(
+        month_digests(current, columns), fill_value=0
+    )
+
+    return list(after.index[before.ne(after)])
 
 
 def dedupe_schedules() -> None:
@@ -164,6 +195,7 @@ def dedupe_schedules() -> None:
     )
 
     rts_count = 0
+    changed = []
 
     for rt in rts:
 
@@ -212,20 +244,38 @@ def dedupe_schedules() -> None:
             inplace=True,
         )
 
+        # convert stop seq to str, like the historic schedule
+        current["stop_sequence"] = current["stop_sequence"].astype(str)
+
         # if historic exists, then combine
         if os.path.exists(f"data/clean_timetables/rt{rt}_timetable.parquet"):
             # for historic schedule, remove anything never than this date
             historic = pd.read_parquet(
                 f"data/clean_timetables/rt{rt}_timetable.parquet"
             )
+
+            # months whose rows differ from the ones the current schedule replaces
+            replaced = historic[historic["bus_stop_time"] >= min_date]
+            months = changed_months(current, replaced)
             historic = historic[historic["bus_stop_time"] < min_date]
 
             # combine current and historic
             deduped_timetable = pd.concat([current, historic])
         else:
             # historic is not just the current
+            months = list(timetable_months(current).dropna().unique())
             deduped_timetable = current
 
+        if rts_count % 40 == 0:
+            metrics_logger.info(f"{round((rts_count/len(rts)) * 100,3)} complete")
+        rts_count += 1
+
+        # the same timetable as before, nothing to write
+        if not months:
+            continue
+
+        changed.append(pd.DataFrame({"rt": str(rt), "month": months}))
+
         # convert stop seq to str
         deduped_timetable["stop_sequence"] = deduped_timetable["stop_sequence"].astype(
             str
@@ -233,9 +283,8 @@ def dedupe_schedules() -> None:
 
         deduped_timetable.to_parquet(f"data/clean_timetables/rt{rt}_timetable.parquet")
 
-        if rts_count % 40 == 0:
-            metrics_logger.info(f"{round((rts_count/len(rts)) * 100,3)} complete")
-        rts_count += 1
+    if changed:
+        record_changed_partitions(pl.from_pandas(pd.concat(changed)))
 
     stats_after = duckdb.execute(command).df()
 
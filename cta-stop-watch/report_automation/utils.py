@@ -4,6 +4,10 @@ import re
 import json
 from datetime import datetime, timedelta
 import logging
+import resource
+import threading
+from contextlib import contextmanager
+from typing import Iterator
 import duckdb
 import polars as pl
 
@@ -113,6 +117,64 @@ def setup_logger(name: str, log_file: str, level=logging.DEBUG) -> logging.Logge
     return logger
 
 
+def current_rss() -> int:
+    """
+    resident memory of this process in bytes, 0 where /proc is not available
+    """
+
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return 0
+
+
+@contextmanager
+def sample_peak_rss(
+    label: str,
+    logger: logging.Logger | None,
+    enabled: bool = True,
+    interval: float = 0.5,
+) -> Iterator[dict]:
+    """
+    sample the resident memory of this process every interval seconds on a
+    background thread while the block runs, then log its peak and the peak of
+    the largest child process that finished (e.g. route workers) if a logger
+    is given. Does nothing unless enabled. Yields a dict whose "rss" is the
+    peak so far
+    """
+
+    peak = {"rss": current_rss()}
+
+    if not enabled:
+        yield peak
+        return
+
+    stop = threading.Event()
+
+    def sample() -> None:
+        while not stop.wait(interval):
+            peak["rss"] = max(peak["rss"], current_rss())
+
+    thread = threading.Thread(target=sample, daemon=True)
+    thread.start()
+
+    try:
+        yield peak
+    finally:
+        stop.set()
+        thread.join()
+        peak["rss"] = max(peak["rss"], current_rss())
+
+        if logger is not None:
+            # ru_maxrss is in kilobytes on linux
+            children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+            logger.info(
+                f"{label} peak memory: {peak['rss'] / 2**20:,.0f} MB, "
+                f"largest child process: {children / 2**20:,.0f} MB"
+            )
+
+
 # Loggers ---------------------------------------------------------------------
 
 formatter = logging.Formatter("%(asctime)s %(levelname)s %(message)s")